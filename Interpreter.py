@@ -1,11 +1,291 @@
-import tkinter as tk
-from tkinter import filedialog, scrolledtext
+import json
+import os
+import sys
 import threading
+from collections import OrderedDict, deque
 from queue import Queue
+from time import monotonic, sleep, time
+
+from markpatch import (  # noqa: F401 — имена ядра доступны и как Interpreter.*
+    PATTERN_CACHE_SIZE, RSEARCH_PROBES, INDEX_MAX_OCCURRENCES, INDEX_MIN_HUNKS, ENGINE_VERSION,
+    RESULT_CACHE_SIZE, RESULT_CACHE_DISK_BYTES, MATCH_TEXT, MATCH_TOKENS, MATCH_MODES, DIFF_CONTEXT,
+    STREAM_CHUNK_BYTES, TRACE_OFF, TRACE_INFO, TRACE_DEBUG, TRACE_VERBOSE, TRACE_LEVELS, TraceEvent,
+    NullSink, LoggingSink, JsonLinesSink, RingBufferSink, Tracer, get_tracer, set_tracer, Metrics,
+    NullMetrics, get_metrics, set_metrics, CompiledPattern, compile_pattern, encode_pattern,
+    SOURCE_SECTION, SOURCE_PATH_SECTION, MATCH_SECTION, PATCH_SECTION, Section, MarkdownDocument,
+    parse_document, extract_section, InvalidFormatError, NoMatchError, OverlapError, LineIndex,
+    SourceIndex, TokenStream, Edit, apply_edit, BlockSearcher, TokenSearcher, match_spans,
+    find_edit, apply_patch, MemoryCache, DiskCache, ResultCache, get_result_cache, set_result_cache,
+    plan_edits, apply_edits, write_edits, patch_file, apply_hunks, iter_unified_diff, unified_diff,
+    diff_hunks, PatchSession, load_document, load_external_document, apply_document, diff_document,
+)
+
+# tkinter загружается только при запуске графического интерфейса (см. run_gui),
+# поэтому пакетный режим работает и без поддержки Tk. Тяжелые модули командной
+# строки (argparse, glob, пулы concurrent.futures, asyncio) также импортируются
+# только там, где используются: import Interpreter не загружает ничего лишнего.
+tk = filedialog = scrolledtext = ttk = None
+
+# Вывод в GUI: размер порции вставки в текстовое поле и число строк,
+# начиная с которого секция изначально свернута
+OUTPUT_CHUNK_CHARS = 64 * 1024
+OUTPUT_EXPAND_LINES = 2000
+
+# Сервер (команда serve): предельный размер запроса и число исходных
+# текстов, для которых сохраняются индексы SourceIndex
+DAEMON_MAX_REQUEST = 64 * 1024 * 1024
+DAEMON_INDEX_CACHE = 16
+
+# Режим наблюдения (apply --watch, флажок Watch): период опроса файлов
+# и время, в течение которого файл не должен меняться (секунды)
+WATCH_INTERVAL = 0.25
+WATCH_DEBOUNCE = 0.3
+
+
+class OutputView:
+    """
+    Вывод результата в текстовое поле секциями (Original, Match, Patch, ...).
+
+    Текст вставляется порциями по OUTPUT_CHUNK_CHARS символов из обработчиков
+    after_idle, поэтому интерфейс отвечает и при выводе нескольких мегабайт.
+    Заголовок секции сворачивает и разворачивает ее по щелчку; свернутые
+    секции в поле не вставляются. Границы тела секции i отмечены метками
+    body<i> (левая гравитация) и end<i> (правая гравитация): текст,
+    вставленный в end<i>, оказывается перед заголовком следующей секции.
+    """
+    def __init__(self, root, text):
+        self.root = root
+        self.text = text
+        self.sections = []      # [(заголовок, текст)]
+        self.expanded = []
+        self.pending = deque()  # (номер секции, порция) для вставки
+        self.generation = 0     # Номер вывода: отменяет порции предыдущего
+        self.scheduled = False
+
+    def show(self, sections, expand=None):
+        """
+        Вывод новых секций вместо текущего содержимого.
+
+        Секции длиннее OUTPUT_EXPAND_LINES строк изначально свернуты,
+        кроме перечисленных в expand.
+        """
+        self.generation += 1
+        self.scheduled = False
+        self.pending.clear()
+        self.sections = list(sections)
+        self.text.delete(1.0, tk.END)
+        for mark in self.text.mark_names():
+            if mark.startswith(('body', 'end')):
+                self.text.mark_unset(mark)
+
+        # Сначала только заголовки, тела секций добавляются порциями
+        self.expanded = []
+        for i, (title, body) in enumerate(self.sections):
+            lines = body.count('\n') + 1
+            self.expanded.append(lines <= OUTPUT_EXPAND_LINES or title in (expand or ()))
+            tag = f"header{i}"
+            self.text.insert(tk.END, self._header(i), (tag, "header"))
+            self.text.tag_bind(tag, "<Button-1>", lambda event, i=i: self.toggle(i))
+        for i, (title, body) in enumerate(self.sections):
+            position = f"{i + 2}.0"     # Начало строки после заголовка секции i
+            self.text.mark_set(f"body{i}", position)
+            self.text.mark_gravity(f"body{i}", tk.LEFT)
+            self.text.mark_set(f"end{i}", position)
+            self.text.mark_gravity(f"end{i}", tk.RIGHT)
+        self.text.tag_config("header", foreground="navy")
+        self.text.tag_bind("header", "<Enter>", lambda event: self.text.config(cursor="hand2"))
+        self.text.tag_bind("header", "<Leave>", lambda event: self.text.config(cursor=""))
+
+        for i in range(len(self.sections)):
+            if self.expanded[i]:
+                self._enqueue(i)
+        self._schedule()
+
+    def update(self, sections, expand=None):
+        """
+        Обновление вывода на месте (режим наблюдения).
+
+        Если заголовки секций не изменились, заменяются только тела
+        измененных секций и строки их заголовков: свернутые секции
+        и остальной текст остаются как были. Иначе — вывод заново (show).
+        """
+        sections = list(sections)
+        if [title for title, _ in sections] != [title for title, _ in self.sections]:
+            self.show(sections, expand)
+            return
+        changed = [i for i, (old, new) in enumerate(zip(self.sections, sections)) if old[1] != new[1]]
+        self.sections = sections
+        for i in changed:
+            self.pending = deque(item for item in self.pending if item[0] != i)
+            self._set_header(i)
+            if self.expanded[i]:
+                self.text.delete(f"body{i}", f"end{i}")
+                self._enqueue(i)
+        self._schedule()
+
+    def _header(self, i):
+        """Строка заголовка секции: состояние, название и число строк"""
+        title, body = self.sections[i]
+        sign = '▼' if self.expanded[i] else '▶'
+        return f"{sign} === {title} === ({body.count(chr(10)) + 1} lines)\n"
+
+    def _enqueue(self, i):
+        """Разбиение тела секции на порции по границам строк"""
+        body = self.sections[i][1]
+        body = body + ('\n' if not body.endswith('\n') else '') + '\n'
+        pos = 0
+        while pos < len(body):
+            cut = body.find('\n', pos + OUTPUT_CHUNK_CHARS)
+            cut = len(body) if cut == -1 else cut + 1
+            self.pending.append((i, body[pos:cut]))
+            pos = cut
+
+    def _schedule(self):
+        if self.pending and not self.scheduled:
+            self.scheduled = True
+            generation = self.generation
+            self.root.after_idle(lambda: self._render_step(generation))
+
+    def _render_step(self, generation):
+        """Вставка одной порции; следующая — в следующем обработчике after_idle"""
+        if generation != self.generation:
+            return      # Порция устаревшего вывода
+        self.scheduled = False
+        if self.pending:
+            i, chunk = self.pending.popleft()
+            self.text.insert(f"end{i}", chunk)
+        self._schedule()
+
+    def _set_header(self, i):
+        """Замена строки заголовка секции i (без перевода строки)"""
+        # Новый текст вставляется после первого символа старого, чтобы
+        # метка end<i-1> в начале строки заголовка осталась на месте
+        start = str(self.text.tag_ranges(f"header{i}")[0])
+        header = self._header(i).rstrip('\n')
+        self.text.insert(f"{start}+1c", header, (f"header{i}", "header"))
+        self.text.delete(start)
+        self.text.delete(f"{start}+{len(header)}c", f"{start} lineend")
+
+    def toggle(self, i):
+        """Сворачивание или разворачивание секции i"""
+        self.expanded[i] = not self.expanded[i]
+        self._set_header(i)
+        if self.expanded[i]:
+            self._enqueue(i)
+            self._schedule()
+        else:
+            self.pending = deque(item for item in self.pending if item[0] != i)
+            self.text.delete(f"body{i}", f"end{i}")
+        return "break"
+
+    def full_text(self):
+        """Все секции целиком (включая свернутые и еще не выведенные)"""
+        return ''.join(f"=== {title} ===\n{body}\n\n" for title, body in self.sections).rstrip('\n')
+
+    def show_message(self, message):
+        """Вывод простого сообщения (например, об ошибке)"""
+        self.show([])
+        self.text.insert(tk.END, message)
+
+
+def result_sections(source, hunks, modified):
+    """Секции вывода: исходный код, пары match/patch и результат"""
+    sections = [("Original", source)]
+    for match, patch in hunks:
+        sections += [("Match", match), ("Patch", patch)]
+    sections.append(("Modified", modified))
+    return sections
+
+
+def _load_any_document(content, file_path, diff=False, mode=MATCH_TEXT):
+    """
+    Разбор документа со встроенным или внешним исходным кодом:
+    (исходный код или None, путь внешнего файла или None, пары).
+
+    Для внешнего файла вывод diff и режим лексем не поддерживаются:
+    ValueError выбрасывается здесь, одинаково для GUI и пакетного режима.
+    """
+    try:
+        source, hunks = load_document(content)
+        return source, None, hunks
+    except InvalidFormatError:
+        # Вместо Source file документ может ссылаться на файл (Source path)
+        external, hunks = load_external_document(content, os.path.dirname(file_path))
+        if external is None:
+            raise
+    if diff:
+        raise ValueError("Diff output is not supported for external source files")
+    if mode != MATCH_TEXT:
+        raise ValueError("Token matching is not supported for external source files")
+    return None, external, hunks
+
+
+def process_gui_job(file_path, trace=False, diff=False, mode=MATCH_TEXT, session=None):
+    """
+    Обработка одного документа для GUI (выполняется в процессе пула).
+
+    Возвращает секции вывода и строку замеров для строки состояния.
+    При diff=True выводится только unified diff изменений, без копий
+    исходного кода и результата. Внешний исходный файл (Source path)
+    в окно не выводится: результат записывается в *.patched рядом
+    с документом, а diff для него не поддерживается (ValueError).
+    mode — режим сопоставления (MATCH_TEXT или MATCH_TOKENS).
+    С session (PatchSession, режим наблюдения; тогда задание выполняется
+    в потоке главного процесса) заново ищутся только измененные пары.
+    Функция не обращается к tkinter: результат передается в главный поток.
+    """
+    metrics = Metrics()
+    with metrics.phase('read'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+    # События трассировки собираются в кольцевой буфер в памяти
+    trace_sink = RingBufferSink() if trace else None
+    tracer = Tracer(trace_sink, TRACE_DEBUG) if trace else None
+    with metrics.phase('parse'):
+        source, external, hunks = _load_any_document(content, file_path, diff, mode)
+    watching = session is not None
+    if session is None:
+        session = PatchSession(mode=mode)
+    if external is not None:
+        # Внешний файл не загружается в окно: результат записывается рядом с документом
+        output_path = os.path.splitext(file_path)[0] + ".patched"
+        edits = patch_file(external, hunks, output_path, tracer=tracer, metrics=metrics, session=session)
+        sections = [(SOURCE_PATH_SECTION, external)]
+        for match, patch in hunks:
+            sections += [("Match", match), ("Patch", patch)]
+        sections.append(("Output", f"{output_path} ({len(edits)} edits)"))
+    elif diff:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        sections = [("Diff", session.diff(source, hunks, tracer, metrics, name))]
+    else:
+        modified = session.apply(source, hunks, tracer, metrics)
+        sections = result_sections(source, hunks, modified)
+    if trace_sink is not None:
+        sections.append(("Trace", '\n'.join(trace_sink.lines())))
+    summary = metrics.summary()
+    if watching:
+        summary += f" | recomputed {len(session.changed)}/{len(hunks)} hunks"
+    return sections, summary
+
 
 class PatchApp:
-    """Главный класс приложения для применения патчей"""
-    def __init__(self, root):
+    """
+    Главный класс приложения для применения патчей.
+
+    Выбранные (или перетащенные) файлы становятся заданиями в пуле
+    процессов ограниченного размера, так что пакет файлов обрабатывается
+    на всех ядрах. Пул завершает задания в своих потоках: они только кладут
+    сообщение в очередь и генерируют событие <<JobsChanged>>, а состояние
+    заданий и виджеты меняются только в главном потоке при обработке
+    события — периодического опроса заданий нет.
+
+    С флажком Watch документы из списка и их внешние исходные файлы
+    проверяются по таймеру (FileWatcher): измененный документ применяется
+    заново в отдельном потоке со своей PatchSession (ищутся только
+    измененные пары), а его результат обновляется на месте.
+    """
+    def __init__(self, root, workers=None, dnd_files=None):
         """Инициализация графического интерфейса и компонентов"""
         self.root = root
         self.root.title("MarkPatch")
@@ -14,14 +294,23 @@ class PatchApp:
         self.frame = tk.Frame(self.root)
         self.frame.pack(padx=10, pady=10)
 
-        # Кнопка открытия файла
+        # Кнопка открытия файлов (можно выбрать несколько)
         self.btn_open = tk.Button(
             self.frame,
-            text="Open Markdown File",
+            text="Open Markdown Files",
             command=self.open_file
         )
         self.btn_open.pack(side=tk.LEFT, padx=5)
 
+        # Кнопка отмены заданий в очереди
+        self.btn_cancel = tk.Button(
+            self.frame,
+            text="Cancel",
+            command=self.cancel_jobs,
+            state=tk.DISABLED
+        )
+        self.btn_cancel.pack(side=tk.LEFT, padx=5)
+
         # Кнопка копирования в буфер обмена
         self.btn_copy = tk.Button(
             self.frame,
@@ -30,6 +319,52 @@ class PatchApp:
         )
         self.btn_copy.pack(side=tk.LEFT, padx=5)
 
+        # Флажок трассировки: события apply_patch выводятся после результата
+        self.trace_enabled = tk.BooleanVar(value=False)
+        self.chk_trace = tk.Checkbutton(
+            self.frame,
+            text="Trace",
+            variable=self.trace_enabled
+        )
+        self.chk_trace.pack(side=tk.LEFT, padx=5)
+
+        # Флажок компактного вывода: только unified diff изменений
+        self.diff_enabled = tk.BooleanVar(value=False)
+        self.chk_diff = tk.Checkbutton(
+            self.frame,
+            text="Diff",
+            variable=self.diff_enabled
+        )
+        self.chk_diff.pack(side=tk.LEFT, padx=5)
+
+        # Флажок сопоставления по лексемам (без учета пробелов и переводов строк)
+        self.tokens_enabled = tk.BooleanVar(value=False)
+        self.chk_tokens = tk.Checkbutton(
+            self.frame,
+            text="Tokens",
+            variable=self.tokens_enabled
+        )
+        self.chk_tokens.pack(side=tk.LEFT, padx=5)
+
+        # Флажок наблюдения: повторное применение при изменении файлов
+        self.watch_enabled = tk.BooleanVar(value=False)
+        self.chk_watch = tk.Checkbutton(
+            self.frame,
+            text="Watch",
+            variable=self.watch_enabled,
+            command=self.toggle_watch
+        )
+        self.chk_watch.pack(side=tk.LEFT, padx=5)
+
+        # Прогресс текущего пакета заданий
+        self.progress = ttk.Progressbar(self.frame, length=160, mode='determinate')
+        self.progress.pack(side=tk.LEFT, padx=5)
+
+        # Список обработанных файлов: выбор показывает результат файла
+        self.lst_results = tk.Listbox(self.root, height=5, width=80, font=('Consolas', 9))
+        self.lst_results.pack(padx=10, fill=tk.X)
+        self.lst_results.bind("<<ListboxSelect>>", self.show_selected)
+
         # Текстовая область с прокруткой для вывода результатов
         self.txt_output = scrolledtext.ScrolledText(
             self.root,
@@ -39,85 +374,269 @@ class PatchApp:
             font=('Consolas', 10)
         )
         self.txt_output.pack(padx=10, pady=10)
+        self.output = OutputView(self.root, self.txt_output)
 
-        # Очередь для межпоточного взаимодействия
+        # Строка состояния: прогресс пакета и замеры выведенного результата (Metrics)
+        self.status_text = tk.StringVar(value="Ready")
+        self.shown_summary = ""
+        self.status_bar = tk.Label(
+            self.root,
+            textvariable=self.status_text,
+            anchor=tk.W,
+            relief=tk.SUNKEN,
+            font=('Consolas', 9)
+        )
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
+        # Перетаскивание файлов (если установлен tkinterdnd2, см. run_gui)
+        if dnd_files is not None:
+            self.txt_output.drop_target_register(dnd_files)
+            self.txt_output.dnd_bind('<<Drop>>', self.on_drop)
+
+        # Задания: пул создается при первом задании
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.cache_dir = None   # Временный каталог дискового кэша пула
+        self.jobs = {}          # номер задания -> (путь, future), только главный поток
+        self.next_job = 0
+        self.batch_total = 0    # Заданий в текущем пакете и завершенных из них
+        self.batch_done = 0
+        self.results = []       # (путь, секции или сообщение об ошибке, замеры)
+        self.result_index = {}  # путь -> номер в results и в списке
+
+        # Наблюдение: сессии документов живут в главном процессе, поэтому
+        # повторные применения выполняются в одном потоке, а не в пуле
+        self.watcher = None
+        self.watch_after = None
+        self.watch_executor = None
+        self.sessions = {}      # путь -> PatchSession
+        self.sources = {}       # путь документа -> внешний исходный файл
+
+        # Очередь сообщений от потоков пула; главный поток будится событием
         self.processing_queue = Queue()
-        self.is_processing = False
-
-        # Запуск периодической проверки очереди
-        self.root.after(100, self.check_queue)
-
-    def check_queue(self):
-        """Обработка сообщений из очереди для обновления интерфейса"""
-        while not self.processing_queue.empty():
-            msg_type, content = self.processing_queue.get()
-
-            if msg_type == "error":     # Обработка ошибок
-                self.txt_output.delete(1.0, tk.END)
-                self.txt_output.insert(tk.END, f"Error: {content}")
-            elif msg_type == "result":  # Вывод результатов
-                self.txt_output.delete(1.0, tk.END)
-                self.txt_output.insert(tk.END, content)
-            elif msg_type == "status":  # Обновление статуса кнопки
-                self.btn_open.config(text=content)
-        # Повторная проверка через 100 мс
-        self.root.after(100, self.check_queue)
+        self.root.bind("<<JobsChanged>>", self.drain_queue)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
 
     def open_file(self):
-        """Обработчик открытия файла с обработкой в отдельном потоке"""
-        if self.is_processing:  # Защита от повторных нажатий
-            return
-
-        file_path = filedialog.askopenfilename(
+        """Выбор одного или нескольких файлов и постановка их в очередь"""
+        file_paths = filedialog.askopenfilenames(
             filetypes=[("Markdown files", "*.md")]
         )
-        if file_path:
-            self.is_processing = True
-            self.btn_open.config(text="Processing...")
-
-            # Запуск обработки в фоновом потоке
-            threading.Thread(
-                target=self.process_file_async,
-                args=(file_path,),
-                daemon=True
-            ).start()
-
-    def process_file_async(self, file_path):
-        """Асинхронная обработка файла с маркдаун-контентом"""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+        self.submit(self.root.tk.splitlist(file_paths))
 
-            # Извлечение секций из файла
-            source = self.extract_section(content, "Source file")
-            match = self.extract_section(content, "match:")
-            patch = self.extract_section(content, "patch")
+    def on_drop(self, event):
+        """Файлы, перетащенные в окно (tkinterdnd2)"""
+        paths = [path for path in self.root.tk.splitlist(event.data) if path.lower().endswith('.md')]
+        self.submit(paths)
+        return event.action
 
-            if not all([source, match, patch]):
-                raise ValueError("Invalid file format")
+    def submit(self, file_paths, refresh=False):
+        """
+        Постановка файлов в очередь пула процессов; при refresh=True —
+        повторное применение в потоке наблюдения
+        """
+        if not file_paths:
+            return
+        if refresh and self.watch_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.watch_executor = ThreadPoolExecutor(max_workers=1)
+        elif not refresh and self.executor is None:
+            import multiprocessing
+            import tempfile
+            from concurrent.futures import ProcessPoolExecutor
+
+            # У каждого процесса пула свой кэш в памяти, а файл может попасть
+            # в любой процесс: общий дисковый уровень на время работы окна
+            # позволяет мгновенно открывать уже обработанные документы
+            self.cache_dir = tempfile.mkdtemp(prefix="markpatch-")
+            cache_path = os.path.join(self.cache_dir, "results.db")
+            # spawn: дочерние процессы не наследуют состояние Tk главного процесса
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_worker,
+                                                initargs=(None, TRACE_OFF, cache_path, RESULT_CACHE_DISK_BYTES, True))
+        if not self.jobs:       # Новый пакет
+            self.batch_total = self.batch_done = 0
+        trace, diff = self.trace_enabled.get(), self.diff_enabled.get()
+        mode = MATCH_TOKENS if self.tokens_enabled.get() else MATCH_TEXT
+        for path in file_paths:
+            job = self.next_job
+            self.next_job += 1
+            if refresh:
+                session = self.sessions.get(path)
+                if session is None or session.mode != mode:
+                    session = self.sessions[path] = PatchSession(mode=mode)
+                future = self.watch_executor.submit(process_gui_job, path, trace, diff, mode, session)
+            else:
+                future = self.executor.submit(process_gui_job, path, trace, diff, mode)
+            self.jobs[job] = (path, future)
+            future.add_done_callback(lambda future, job=job: self._job_finished(job))
+        self.batch_total += len(file_paths)
+        self.update_progress()
+
+    def _job_finished(self, job):
+        """Завершение задания (поток пула): сообщение в очередь и пробуждение главного потока"""
+        self.processing_queue.put(job)
+        try:
+            self.root.event_generate("<<JobsChanged>>", when="tail")
+        except (RuntimeError, tk.TclError):
+            pass    # Окно уже закрыто
 
-            # Применение патча
-            modified = self.apply_patch(source, match, patch)
+    def drain_queue(self, event=None):
+        """Обработка завершенных заданий (главный поток, по событию <<JobsChanged>>)"""
+        while not self.processing_queue.empty():
+            job = self.processing_queue.get()
+            path, future = self.jobs.pop(job, (None, None))
+            if future is None:
+                continue    # Задание отменено
+            self.batch_done += 1
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                self.add_result(path, f"Error: {error}", None)
+            else:
+                sections, summary = future.result()
+                self.add_result(path, sections, summary)
+        self.update_progress()
 
-            # Формирование результата
-            result = (
-                    "=== Original ===\n" + source +
-                    "\n\n=== Match ===\n" + match +
-                    "\n\n=== Patch ===\n" + patch +
-                    "\n\n=== Modified ===\n" + modified
-            )
-            self.processing_queue.put(("result", result))
+    def add_result(self, path, sections, summary):
+        """
+        Добавление результата в список; первый результат пакета выводится
+        сразу. Результат уже обработанного файла заменяет прежний на месте.
+        """
+        failed = isinstance(sections, str)
+        label = f"{'✗' if failed else '✓'} {os.path.basename(path)}"
+        if not failed:
+            self.sources[path] = dict(sections).get(SOURCE_PATH_SECTION)
+        index = self.result_index.get(path)
+        if index is not None:
+            previous = self.results[index][1]
+            self.results[index] = (path, sections, summary)
+            selected = index in self.lst_results.curselection()
+            self.lst_results.delete(index)
+            self.lst_results.insert(index, label)
+            if selected:
+                self.lst_results.selection_set(index)
+                if failed or isinstance(previous, str):
+                    self.show_result(index)
+                else:
+                    self.output.update(sections, expand=("Modified",))
+                    self.shown_summary = f"{os.path.basename(path)}: {summary}"
+                    self.update_status()
+            return
+        self.result_index[path] = len(self.results)
+        self.results.append((path, sections, summary))
+        self.lst_results.insert(tk.END, label)
+        if not self.lst_results.curselection():
+            index = len(self.results) - 1
+            self.lst_results.selection_set(index)
+            self.show_result(index)
+
+    def show_selected(self, event=None):
+        """Вывод результата выбранного в списке файла"""
+        selection = self.lst_results.curselection()
+        if selection:
+            self.show_result(selection[0])
+
+    def show_result(self, index):
+        path, sections, summary = self.results[index]
+        if isinstance(sections, str):
+            self.output.show_message(sections)
+        else:
+            self.output.show(sections, expand=("Modified",))
+        self.shown_summary = f"{os.path.basename(path)}: {summary}" if summary else ""
+        self.update_status()
+
+    def update_progress(self):
+        """Обновление индикатора прогресса и доступности кнопки отмены"""
+        self.progress.config(maximum=max(self.batch_total, 1), value=self.batch_done)
+        self.btn_cancel.config(state=tk.NORMAL if self.jobs else tk.DISABLED)
+        self.update_status()
+
+    def update_status(self):
+        """
+        Строка состояния: прогресс пакета (или итог завершенного пакета)
+        и замеры выведенного результата, которые прогресс не затирает
+        """
+        parts = []
+        if self.jobs:
+            parts.append(f"Processing {self.batch_done}/{self.batch_total}...")
+        elif self.batch_total:
+            parts.append(f"Done {self.batch_done}/{self.batch_total}")
+        if self.shown_summary:
+            parts.append(self.shown_summary)
+        self.status_text.set(" — ".join(parts) or "Ready")
+
+    def cancel_jobs(self):
+        """
+        Отмена заданий текущего пакета.
 
-        except Exception as e:
-            self.processing_queue.put(("error", str(e)))
-        finally:
-            # Сброс статуса обработки
-            self.processing_queue.put(("status", "Open Markdown File"))
-            self.is_processing = False
+        Задания, еще не начатые пулом, отменяются; результаты уже
+        выполняющихся заданий будут отброшены.
+        """
+        cancelled = len(self.jobs)
+        for path, future in self.jobs.values():
+            future.cancel()
+        self.jobs.clear()
+        self.batch_done = self.batch_total
+        self.update_progress()
+        self.status_text.set(f"Cancelled {cancelled} job(s)")
+
+    def toggle_watch(self):
+        """Включение или выключение наблюдения за обработанными файлами"""
+        if self.watch_after is not None:
+            self.root.after_cancel(self.watch_after)
+            self.watch_after = None
+        if not self.watch_enabled.get():
+            self.watcher = None
+            return
+        self.watcher = FileWatcher()
+        self.watcher.set_paths(self.watched_paths())
+        self.watch_after = self.root.after(int(WATCH_INTERVAL * 1000), self.poll_watch)
+
+    def watched_paths(self):
+        """Документы из списка результатов и их внешние исходные файлы"""
+        return list(self.result_index) + [source for source in self.sources.values() if source]
+
+    def poll_watch(self):
+        """Проверка файлов по таймеру: измененные документы применяются заново"""
+        self.watch_after = None
+        changed = set(self.watcher.poll())
+        refresh = [path for path in self.result_index if path in changed or self.sources.get(path) in changed]
+        self.submit(refresh, refresh=True)
+        self.watcher.set_paths(self.watched_paths())
+        self.watch_after = self.root.after(int(WATCH_INTERVAL * 1000), self.poll_watch)
+
+    def close(self):
+        """Закрытие окна: отмена заданий, наблюдения и остановка пулов"""
+        for path, future in self.jobs.values():
+            future.cancel()
+        self.jobs.clear()
+        if self.watch_after is not None:
+            self.root.after_cancel(self.watch_after)
+        for executor in (self.executor, self.watch_executor):
+            if executor is not None:
+                executor.shutdown(wait=False)
+        if self.cache_dir is not None:
+            import shutil
+
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.root.destroy()
 
     def copy_to_clipboard(self):
-        """Копирование содержимого текстовой области в буфер обмена"""
-        content = self.txt_output.get(1.0, tk.END)
+        """
+        Копирование результата в буфер обмена (все секции, включая свернутые).
+
+        В режиме Diff копируется только diff, чтобы его можно было применить
+        (git apply, patch).
+        """
+        diff = dict(self.output.sections).get("Diff")
+        if diff is not None:
+            content = diff
+        else:
+            content = self.output.full_text() if self.output.sections else self.txt_output.get(1.0, tk.END)
         self.root.clipboard_clear()
         self.root.clipboard_append(content)
 
@@ -126,359 +645,622 @@ class PatchApp:
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
 
-            source = self.extract_section(content, "Source file")
-            match = self.extract_section(content, "match:")
-            patch = self.extract_section(content, "patch")
-
-            if not all([source, match, patch]):
-                raise ValueError("Invalid file format")
-
-            modified = self.apply_patch(source, match, patch)
-
-            self.txt_output.delete(1.0, tk.END)
-            self.txt_output.insert(tk.END, "=== Original ===\n")
-            self.txt_output.insert(tk.END, source)
-            self.txt_output.insert(tk.END, "\n\n=== Match ===\n")
-            self.txt_output.insert(tk.END, match)
-            self.txt_output.insert(tk.END, "\n\n=== Patch ===\n")
-            self.txt_output.insert(tk.END, patch)
-            self.txt_output.insert(tk.END, "\n\n=== Modified ===\n")
-            self.txt_output.insert(tk.END, modified)
+            source, hunks, modified = self.apply_document(content)
+            self.output.show(result_sections(source, hunks, modified), expand=("Modified",))
 
         except Exception as e:
-            self.txt_output.delete(1.0, tk.END)
-            self.txt_output.insert(tk.END, f"Error: {str(e)}")
-
-    def extract_section(self, content, section_name):
-        """
-                Извлечение секции кода из маркдаун-контента
-
-                Алгоритм:
-                1. Поиск заголовка нужной секции
-                2. Поиск следующего блока кода (между ```)
-                3. Сбор содержимого блока до закрывающего ```
-                """
-        lines = content.split('\n')
-        in_section = False
-        section_content = []
-        code_block = False
-        found_header = False
-
-        target_header = section_name.strip().lower()
-
-        for line in lines:
-            stripped_line = line.strip()
-
-            # Поиск заголовка секции
-            if not found_header and stripped_line.lower().startswith('#'):
-                header_text = stripped_line.lstrip('#').strip().lower()
-                if header_text == target_header:
-                    found_header = True
-                    continue
-
-            # Поиск начала блока кода
-            if found_header and not code_block:
-                if stripped_line.startswith('```'):
-                    code_block = True
-                    continue
-                else:
-                    continue    # Пропуск текста вне блока кода
+            self.output.show_message(f"Error: {str(e)}")
 
-            # Содержимое блока кода
-            if code_block:
-                if stripped_line.startswith('```'):
-                    break   # Конец блока кода
-                section_content.append(line)
+    def apply_document(self, content, tracer=None, metrics=None):
+        """Применение всех пар match/patch документа (см. apply_document)"""
+        return apply_document(content, tracer=tracer, metrics=metrics)
 
-        return '\n'.join(section_content).strip() if section_content else None
+    def extract_section(self, content, section_name):
+        """Извлечение секции кода из маркдаун-контента (см. extract_section)"""
+        return extract_section(content, section_name)
 
     def apply_patch(self, source, match_pattern, patch):
-        """
-        Применяет патч к исходному коду на основе шаблона.
+        """Применение патча к исходному коду (см. apply_patch)"""
+        return apply_patch(source, match_pattern, patch)
+
+# Статусы обработки документа в пакетном режиме
+STATUS_APPLIED = "applied"
+STATUS_NO_MATCH = "no-match"
+STATUS_INVALID = "invalid-format"
+STATUS_CONFLICT = "conflict"
+STATUS_ERROR = "error"
+
+# Счетчики кэша результатов в записи документа и в сводке
+_CACHE_COUNTERS = ("hits", "memory_hits", "disk_hits", "misses")
+
+
+def process_document_file(file_path, output_path, diff=False, in_place=False, mode=MATCH_TEXT, session=None):
+    """
+    Обработка одного документа в пакетном режиме.
+
+    Результат (при diff=True — unified diff изменений) записывается
+    в output_path, возвращается запись для сводки. Внешний исходный файл
+    (секция Source path) обрабатывается patch_file: при in_place=True он
+    атомарно заменяется результатом. mode — режим сопоставления
+    (MATCH_TEXT или MATCH_TOKENS). В режиме наблюдения передается
+    session (PatchSession документа): заново ищутся только измененные
+    пары, их номера — в поле "changed" записи. Функция выполняется
+    в процессах пула, поэтому она не обращается к GUI.
+    """
+    record = {"path": file_path, "status": STATUS_APPLIED, "output": None, "message": None}
+    tracer = get_tracer()
+    cache = get_result_cache()
+    before = cache.stats() if cache else None
+    metrics = Metrics()
+    if tracer.level >= TRACE_INFO:
+        tracer.emit('document', TRACE_INFO, path=file_path)
+    watching = session is not None
+    if session is None:
+        session = PatchSession(strict=True, mode=mode)
+    session.changed = []    # Документ может не дойти до поиска (ошибка разбора)
+    try:
+        with metrics.phase('read'):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        with metrics.phase('parse'):
+            source, external, hunks = _load_any_document(content, file_path, diff, mode)
+        if external is not None:
+            record["source"] = external
+            output_path = external if in_place else output_path
+            patch_file(external, hunks, None if in_place else output_path, metrics=metrics, session=session)
+        else:
+            # Индекс строится сессией один раз на версию исходного кода
+            # (при первом промахе кэша) и переиспользуется всеми парами
+            if diff:
+                name = os.path.splitext(os.path.basename(file_path))[0]
+                output = session.diff(source, hunks, metrics=metrics, name=name)
+            else:
+                output = session.apply(source, hunks, metrics=metrics)
+            # В режиме лексем строится только поток лексем (индекс слов — нет),
+            # его размер и время тоже входят в stats()
+            if session.index is not None:
+                record["index"] = session.index.stats()
+            with metrics.phase('write'):
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    f.write(output)
+        record["output"] = output_path
+    except InvalidFormatError as e:
+        record.update(status=STATUS_INVALID, message=str(e))
+    except NoMatchError as e:
+        record.update(status=STATUS_NO_MATCH, message=str(e))
+    except OverlapError as e:
+        record.update(status=STATUS_CONFLICT, message=str(e))
+    except Exception as e:
+        record.update(status=STATUS_ERROR, message=str(e))
+    if cache:
+        after = cache.stats()
+        record["cache"] = {name: after[name] - before[name] for name in _CACHE_COUNTERS}
+    if watching:
+        record["changed"] = session.changed
+    record["metrics"] = metrics.to_dict()
+    return record
+
+
+def _process_task(task):
+    """Обертка для пула процессов: задача — аргументы process_document_file"""
+    return process_document_file(*task)
+
+
+def setup_trace(trace_path, trace_level):
+    """
+    Включение трассировки в JSON Lines для пакетного режима.
+
+    Вызывается в каждом процессе пула: файл открывается на дозапись
+    с построчной буферизацией, так что строки разных процессов не смешиваются.
+    """
+    if not trace_path or trace_level == TRACE_OFF:
+        return
+    stream = sys.stderr if trace_path == "-" else open(trace_path, 'a', encoding='utf-8', buffering=1)
+    set_tracer(Tracer(JsonLinesSink(stream), trace_level))
+
+
+def setup_cache(cache_path=None, cache_bytes=RESULT_CACHE_DISK_BYTES, enabled=True):
+    """
+    Настройка глобального кэша результатов для пакетного режима.
+
+    Вызывается в каждом процессе пула: у процесса свой уровень в памяти,
+    а дисковый уровень (база sqlite в cache_path) общий.
+    """
+    if not enabled:
+        set_result_cache(False)
+        return
+    disk = DiskCache(cache_path, cache_bytes) if cache_path else None
+    set_result_cache(ResultCache(disk=disk))
+
+
+def _init_worker(trace_path, trace_level, cache_path, cache_bytes, cache_enabled):
+    """Инициализация процесса пула: трассировка и кэш результатов"""
+    setup_trace(trace_path, trace_level)
+    setup_cache(cache_path, cache_bytes, cache_enabled)
+
+
+def collect_documents(inputs):
+    """Раскрытие аргументов командной строки (файлы, каталоги, glob-шаблоны) в список .md"""
+    import glob
+
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = glob.glob(os.path.join(item, '**', '*.md'), recursive=True)
+        elif glob.has_magic(item):
+            found = glob.glob(item, recursive=True)
+        else:
+            found = [item]
+        paths.extend(sorted(found))
+    return list(dict.fromkeys(paths))    # Удаление дубликатов с сохранением порядка
+
+
+def output_path_for(file_path, base_dir, output_dir, suffix=".patched"):
+    """Путь результата: рядом с документом или в output_dir с сохранением структуры"""
+    stem = os.path.splitext(file_path)[0] + suffix
+    if output_dir is None:
+        return stem
+    return os.path.join(output_dir, os.path.relpath(stem, base_dir))
+
+
+def run_batch(paths, jobs=None, output_dir=None, chunksize=None, trace_path=None, trace_level=TRACE_INFO,
+              cache_path=None, cache_bytes=RESULT_CACHE_DISK_BYTES, cache_enabled=True, diff=False,
+              in_place=False, mode=MATCH_TEXT):
+    """
+    Применение патчей из множества документов в пуле процессов.
+
+    При diff=True вместо результатов (*.patched) записываются unified diff
+    изменений (*.diff), при in_place=True внешние исходные файлы документов
+    (Source path) заменяются результатом. mode — режим сопоставления
+    (MATCH_TEXT или MATCH_TOKENS). Возвращает сводку: количество документов по статусам, попадания
+    в кэш результатов и записи по файлам.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else ''
+    tasks = []
+    for path in paths:
+        out = output_path_for(os.path.abspath(path), base_dir, output_dir, ".diff" if diff else ".patched")
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        tasks.append((path, out, diff, in_place, mode))
+
+    if jobs == 1 or len(tasks) <= 1:
+        previous_tracer, previous_cache = get_tracer(), get_result_cache()
+        _init_worker(trace_path, trace_level, cache_path, cache_bytes, cache_enabled)
+        try:
+            records = [_process_task(task) for task in tasks]
+        finally:
+            cache = get_result_cache()
+            if cache and cache.disk is not None:
+                cache.disk.close()
+            set_tracer(previous_tracer)
+            set_result_cache(previous_cache)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Задачи отправляются пачками, чтобы снизить накладные расходы на IPC
+        chunksize = chunksize or max(1, len(tasks) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(trace_path, trace_level, cache_path, cache_bytes,
+                                           cache_enabled)) as executor:
+            records = list(executor.map(_process_task, tasks, chunksize=chunksize))
+
+    summary = {
+        "total": len(records),
+        STATUS_APPLIED: 0,
+        STATUS_NO_MATCH: 0,
+        STATUS_INVALID: 0,
+        STATUS_CONFLICT: 0,
+        STATUS_ERROR: 0,
+    }
+    cache = dict.fromkeys(_CACHE_COUNTERS, 0)
+    phases, counters = {}, {}     # Сумма замеров по всем документам
+    for record in records:
+        summary[record["status"]] += 1
+        for name, value in record.get("cache", {}).items():
+            cache[name] += value
+        for name, value in record["metrics"]["phases_ms"].items():
+            phases[name] = phases.get(name, 0.0) + value
+        for name, value in record["metrics"]["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    lookups = cache["hits"] + cache["misses"]
+    cache["hit_rate"] = round(cache["hits"] / lookups, 4) if lookups else 0.0
+    summary["cache"] = cache
+    summary["metrics"] = {"phases_ms": {name: round(value, 3) for name, value in phases.items()},
+                          "counters": counters}
+    summary["files"] = records
+    return summary
+
+
+class FileWatcher:
+    """
+    Наблюдение за изменением файлов опросом os.stat.
+
+    Изменение (время изменения или размер, появление или удаление файла)
+    сообщается, когда файл не менялся еще debounce секунд: серия записей
+    при сохранении в редакторе дает одно событие.
+    """
+    def __init__(self, debounce=WATCH_DEBOUNCE):
+        self.debounce = debounce
+        self.stamps = {}    # путь -> (mtime_ns, размер) или None, если файла нет
+        self.pending = {}   # путь -> время последнего замеченного изменения
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def set_paths(self, paths):
+        """Набор наблюдаемых файлов; состояние новых запоминается без события"""
+        self.stamps = {path: self.stamps[path] if path in self.stamps else self._stamp(path) for path in paths}
+        self.pending = {path: changed for path, changed in self.pending.items() if path in self.stamps}
+
+    def poll(self, now=None):
+        """Файлы, изменения которых устоялись к моменту now (time.monotonic)"""
+        if now is None:
+            now = monotonic()
+        for path, stamp in self.stamps.items():
+            current = self._stamp(path)
+            if current != stamp:
+                self.stamps[path] = current
+                self.pending[path] = now
+        ready = [path for path, changed in self.pending.items() if now - changed >= self.debounce]
+        for path in ready:
+            del self.pending[path]
+        return ready
+
+
+def run_watch(paths, output_dir=None, diff=False, mode=MATCH_TEXT, debounce=WATCH_DEBOUNCE,
+              interval=WATCH_INTERVAL, stream=None):
+    """
+    Режим наблюдения (apply --watch): применение документов и повторное
+    применение при изменении документа или его внешнего исходного файла.
+
+    Документы обрабатываются в текущем процессе, у каждого своя
+    PatchSession: после изменения заново ищутся только измененные пары
+    (или все, если изменился исходный код). Запись каждого применения
+    выводится в stream одной строкой JSON. Работает до KeyboardInterrupt.
+    """
+    stream = stream or sys.stdout
+    base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else ''
+    outputs = {}
+    for path in paths:
+        outputs[path] = output_path_for(os.path.abspath(path), base_dir, output_dir, ".diff" if diff else ".patched")
+        os.makedirs(os.path.dirname(outputs[path]) or '.', exist_ok=True)
+    sessions = {path: PatchSession(strict=True, mode=mode) for path in paths}
+    sources = {}    # документ -> внешний исходный файл (Source path)
+    watcher = FileWatcher(debounce)
+
+    def process(path):
+        record = process_document_file(path, outputs[path], diff, False, mode, sessions[path])
+        sources[path] = record.get("source")
+        print(json.dumps(record, ensure_ascii=False), file=stream, flush=True)
+
+    try:
+        for path in paths:
+            process(path)
+        while True:
+            watcher.set_paths(list(paths) + [source for source in sources.values() if source])
+            sleep(interval)
+            changed = set(watcher.poll())
+            for path in paths:
+                if path in changed or sources.get(path) in changed:
+                    process(path)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+class PatchServer:
+    """
+    Долгоживущий сервер применения патчей на Unix-сокете (команда serve).
+
+    Протокол — JSON Lines: одна строка запроса, одна строка ответа.
+    Запросы:
+    - {"document": "<Markdown>"} — применение всех пар документа;
+    - {"source": ..., "match": ..., "patch": ...} — одна пара;
+    - {"op": "ping"} и {"op": "stats"} — проверка и состояние кэшей.
+    Необязательные поля: "id" (возвращается в ответе), "strict"
+    (по умолчанию true), "diff" (вернуть unified diff в поле "diff"
+    вместо результата) и "mode" ("text" или "tokens"). Ответ на применение: {"id", "status", "result",
+    "message", "metrics"}, статусы — как в пакетном режиме.
+
+    Между запросами остаются «теплыми» скомпилированные шаблоны
+    (compile_pattern), кэш результатов (ResultCache) и индексы SourceIndex
+    последних DAEMON_INDEX_CACHE исходных текстов: индекс создается для
+    документа с большим числом пар или для текста, который уже встречался.
+    Соединения обслуживаются asyncio одновременно, применение патчей
+    выполняется в пуле потоков, чтобы цикл событий не блокировался.
+    """
+    def __init__(self, socket_path, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.socket_path = socket_path
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.sources = OrderedDict()    # исходный код -> SourceIndex (None — встречался один раз)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.started = time()
+
+    def _index_for(self, source, hunks):
+        """Индекс для исходного кода из LRU или None, если он пока не нужен"""
+        with self.lock:
+            seen = source in self.sources
+            index = self.sources.get(source)
+            if index is None and (seen or len(hunks) >= INDEX_MIN_HUNKS):
+                index = SourceIndex(source)
+            self.sources[source] = index
+            self.sources.move_to_end(source)
+            while len(self.sources) > DAEMON_INDEX_CACHE:
+                self.sources.popitem(last=False)
+            return index
+
+    def stats(self):
+        """Состояние сервера и кэшей"""
+        cache = get_result_cache()
+        with self.lock:
+            indexes = sum(1 for index in self.sources.values() if index is not None)
+        return {
+            "status": "ok",
+            "requests": self.requests,
+            "uptime_s": round(time() - self.started, 3),
+            "patterns": compile_pattern.cache_info()._asdict(),
+            "results": cache.stats() if cache else None,
+            "indexes": indexes,
+        }
+
+    def handle(self, request):
+        """Обработка одного запроса (выполняется в пуле потоков): словарь ответа"""
+        op = request.get("op", "apply")
+        if op == "ping":
+            return {"status": "ok"}
+        if op == "stats":
+            return self.stats()
+        if op != "apply":
+            return {"status": STATUS_ERROR, "message": f"Unknown op '{op}'"}
+
+        response = {"status": STATUS_APPLIED, "result": None, "message": None}
+        metrics = Metrics()
+        try:
+            if "document" in request:
+                with metrics.phase('parse'):
+                    source, hunks = load_document(request["document"])
+            else:
+                source = request["source"]
+                hunks = [(request["match"], request["patch"])]
+            index = self._index_for(source, hunks)
+            strict = request.get("strict", True)
+            mode = request.get("mode", MATCH_TEXT)
+            if request.get("diff"):
+                response["diff"] = diff_hunks(source, hunks, strict=strict, index=index, metrics=metrics,
+                                              mode=mode)
+            else:
+                response["result"] = apply_hunks(source, hunks, strict=strict, index=index, metrics=metrics,
+                                                 mode=mode)
+        except InvalidFormatError as e:
+            response.update(status=STATUS_INVALID, message=str(e))
+        except NoMatchError as e:
+            response.update(status=STATUS_NO_MATCH, message=str(e))
+        except OverlapError as e:
+            response.update(status=STATUS_CONFLICT, message=str(e))
+        except KeyError as e:
+            response.update(status=STATUS_ERROR, message=f"Missing field {e}")
+        except Exception as e:
+            response.update(status=STATUS_ERROR, message=str(e))
+        response["metrics"] = metrics.to_dict()
+        return response
 
-        Логика работы:
-        1. Токенизация шаблона на элементы: текст, wildcard (...), маркеры (>>> и <<<).
-        2. Поиск соответствий токенов в исходном коде.
-        3. Вставка или замена текста согласно патчу.
-        """
-        print("\n" + "=" * 50)
-        print("[DEBUG] Starting apply_patch")
-        print("=" * 50)
-        print(f"[DEBUG] Match Pattern:\n{match_pattern}")
-        print(f"[DEBUG] Patch:\n{patch}")
-        print(f"[DEBUG] Original Source:\n{source}")
-
-        # Токенизация шаблона
-        parts = []          # Список токенов (тип, значение)
-        buffer = []         # Буфер для накопления символов текста
-        i = 0               # Индекс текущего символа в шаблоне
-        n = len(match_pattern)
-        insert_pos = None   # Позиция маркера вставки (>>>)
-
-        print("\n[DEBUG] Tokenizing match pattern:")
-        # Проход по всем символам шаблона
-        while i < n:
-            # Обработка специальных последовательностей
-            # Wildcard (...) — пропуск произвольного текста
-            if i + 2 < n and match_pattern[i:i + 3] == '...':
-                # Добавление накопленного текста перед wildcard
-                if buffer:
-                    text = ''.join(buffer).strip()
-                    if text:
-                        parts.append(('text', text))
-                        print(f"  [TOKEN] Added TEXT: '{text}'")
-                    buffer = []
-                parts.append(('wildcard', None))
-                print("  [TOKEN] Added WILDCARD (...)")
-                i += 3
-            elif i + 2 < n and match_pattern[i:i + 3] == '>>>': # Маркер начала замены (>>>)
-                if buffer:
-                    text = ''.join(buffer).strip()
-                    if text:
-                        parts.append(('text', text))
-                        print(f"  [TOKEN] Added TEXT: '{text}'")
-                    buffer = []
-                insert_pos = len(parts)
-                parts.append(('marker', None))  # Фиксация позиции для вставки
-                print("  [TOKEN] Added MARKER (>>>)")
-                i += 3
-            elif i + 2 < n and match_pattern[i:i + 3] == '<<<': # Маркер конца замены (<<<)
-                if buffer:
-                    text = ''.join(buffer).strip()
-                    if text:
-                        parts.append(('text', text))
-                        print(f"  [TOKEN] Added TEXT: '{text}'")
-                    buffer = []
-                parts.append(('end_replace', None))
-                print("  [TOKEN] Added END_REPLACE (<<<)")
-                i += 3
-            else:   # Обычные символы (накопление в буфер)
-                buffer.append(match_pattern[i])
-                i += 1
-        if buffer:  # Добавление оставшегося текста после последнего токена
-            text = ''.join(buffer).strip()
-            if text:
-                parts.append(('text', text))
-                print(f"  [TOKEN] Added FINAL TEXT: '{text}'")
-
-        if insert_pos is None:  # Поиск маркера вставки (>>>), если не был найден
-            for idx, (p_type, _) in enumerate(parts):
-                if p_type == 'marker':
-                    insert_pos = idx
-                    break
-            if insert_pos is None:
-                print("[ERROR] Marker (>>>) not found!")
-                return source   # Если маркер отсутствует, возврат исходного кода
-
-        print("\n[DEBUG] Tokens:")
-        for idx, (p_type, p_val) in enumerate(parts):
-            print(f"  {idx}: {p_type.upper()}" + (f" -> '{p_val}'" if p_val else ""))
-
-        # Поиск соответствий токенов в исходном коде
-        source_lines = source.split('\n')
-        current_part = 0            # Текущий обрабатываемый токен
-        line_num = 0                # Номер текущей строки исходного кода
-        last_matched_pos = 0        # Позиция последнего совпадения в строке
-        insert_line = -1
-        insert_column = -1
-        marker_reached = False      # Флаг достижения маркера >>>
-
-        print("\n[DEBUG] Matching tokens to source lines:")
-        # Проход по строкам исходного кода
-        while line_num < len(source_lines) and current_part < len(parts):
-            part_type, part_value = parts[current_part]
-
-            if part_type == 'text':
-                # Поиск точного совпадения текста
-                found = False
-                while line_num < len(source_lines):
-                    line = source_lines[line_num]
-                    pos = line.find(part_value, last_matched_pos)
-                    if pos != -1:
-                        print(f"  [MATCH] Line {line_num + 1}: Found '{part_value}' at {pos}")
-                        # Совпадение найдено — переход к следующему токену
-                        current_part += 1
-                        insert_line = line_num
-                        insert_column = pos + len(part_value)
-                        last_matched_pos = 0
-                        found = True
-                        break
-                    else:
-                        print(f"  [MISS] Line {line_num + 1}: '{line}' does not contain '{part_value}'")
-                        # Переход к следующей строке
-                        line_num += 1
-                        last_matched_pos = 0
-                if not found:
-                    print("[DEBUG] Text token not found!")
-                    return source   # Токен не найден, отмена изменений
-            # Обработка wildcard — пропуск до следующего токена
-            elif part_type == 'wildcard':
-                print(f"  [WILDCARD] Part {current_part}")
-                current_part += 1
-                # Если следующий токен маркер, то поиск прерывается
-                if current_part < len(parts) and parts[current_part][0] in ('marker', 'end_replace'):
-                    marker_reached = True
-                    print("  [MARKER/END_REPLACE] Reached, stopping search")
-                    break
+    async def _serve_client(self, reader, writer):
+        """Обслуживание одного соединения: запросы обрабатываются по очереди"""
+        import asyncio
 
-                if current_part < len(parts):
-                    # Получаем следующий токен после wildcard
-                    next_type, next_value = parts[current_part]
-                    found = False
-                    start_line = line_num   # Запоминаем стартовую строку для поиска
-
-                    # Поиск совпадения в следующих строках исходного кода
-                    while line_num < len(source_lines):
-                        line = source_lines[line_num]
-
-                        # Ищем точное совпадение значения токена в текущей строке
-                        pos = line.find(next_value, 0)  # Поиск с начала строки
-                        if pos != -1:
-                            print(f"  [MATCH] Line {line_num + 1}: Found '{next_value}' after wildcard at {pos}")
-                            # Совпадение найдено: обновляем позиции и переходим к следующему токену
-                            current_part += 1                       # Переход к следующему токену
-                            insert_line = line_num                  # Запоминаем строку для вставки
-                            insert_column = pos + len(next_value)   # Позиция после найденного текста
-                            found = True
-                            break
-                        else:
-                            line_num += 1   # Совпадение не найдено: переходим к следующей строке
-                    if not found:   # Если токен после wildcard не был найден во всем коде
-                        print(f"  [WILDCARD FAIL] Could not find '{next_value}'")
-                        return source   # Возвращаем исходный код без изменений
-            # Достигнут маркер вставки — выход из цикла
-            elif part_type == 'marker':
-                marker_reached = True
-                current_part += 1   # Переходим к следующему токену
-                break               # Прерываем цикл поиска, так как достигли точки вставки
-            elif part_type == 'end_replace':
-                current_part += 1   # Просто переходим к следующему токену (логика замены завершена)
-
-        # Валидация: проверяем, что маркер вставки был достигнут
-        if not marker_reached:
-            print("[DEBUG] Marker not reached!")
-            return source   # Если маркер >>> не найден, отменяем изменения
-
-        # Применение изменений
-        modified_lines = source_lines.copy()     # Создаем копию для модификации
-        replace_text = None
-        end_replace_pos = -1
-
-        # Поиск текста для замены между >>> и <<<
-        if current_part < len(parts) - 1:
-            next_type, next_value = parts[current_part]
-            next_next_type, next_next_value = parts[current_part + 1]
-
-            # Если структура: [текст] -> [end_replace], сохраняем текст для замены
-            if next_type == 'text' and next_next_type == 'end_replace':
-                replace_text = next_value           # Текст между >>> и <<<
-                end_replace_pos = current_part + 1  # Позиция конца замены
-
-        # Вариант 1: Замена существующего текста
-        if replace_text is not None:
-            print(f"\n[DEBUG] Performing replacement of '{replace_text}' with '{patch}'")
-            found = False
-
-            # Поиск текста для замены начиная с позиции вставки
-            for line_idx in range(insert_line, len(modified_lines)):
-                line = modified_lines[line_idx]
-
-                # Определяем стартовую позицию поиска:
-                # - Для первой строки: с позиции вставки
-                # - Для последующих: с начала строки
-                start_pos = insert_column if line_idx == insert_line else 0
-                pos = line.find(replace_text, start_pos)
-                if pos != -1:
-                    print(f"  [REPLACE] Found '{replace_text}' at line {line_idx + 1}, position {pos}")
-                    # Замена текста на патч
-                    new_line = line[:pos] + patch + line[pos + len(replace_text):]
-                    modified_lines[line_idx] = new_line
-                    found = True
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:      # Строка длиннее DAEMON_MAX_REQUEST
+                    writer.write(b'{"status": "error", "message": "Request too large"}\n')
                     break
-            if not found:
-                print(f"  [REPLACE FAIL] Could not find '{replace_text}' after marker")
-                return source   # Отмена изменений при ошибке
-            current_part = end_replace_pos + 1
-        else:   # Вариант 2: Вставка нового текста
-            # Поиск первого текстового токена после маркера для позиционирования
-            post_marker_token = None
-            for p_type, p_val in parts[current_part:]:
-                if p_type == 'text':
-                    post_marker_token = p_val
+                if not line:
                     break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request must be a JSON object")
+                except ValueError as e:
+                    response = {"status": STATUS_ERROR, "message": f"Invalid request: {e}"}
+                else:
+                    self.requests += 1
+                    response = await loop.run_in_executor(self.executor, self.handle, request)
+                    if "id" in request:
+                        response["id"] = request["id"]
+                writer.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
-            if post_marker_token:
-                print(f"\n[DEBUG] Searching for post-marker token: '{post_marker_token}'")
-                # Поиск первого текстового токена после маркера для позиционирования
-                found = False
-                search_line = insert_line   # Начинаем поиск с текущей позиции
-                while search_line < len(modified_lines):
-                    pos = modified_lines[search_line].find(post_marker_token)
-                    if pos != -1:
-                        print(f"  [POST-MARKER] Found at line {search_line + 1}")
-                        # Найден ориентир для вставки
-                        insert_line = search_line
-                        insert_column = pos     # Позиция перед токеном
-                        found = True
-                        break
-                    search_line += 1
-                if not found:
-                    print(f"  [POST-MARKER FAIL] Token '{post_marker_token}' not found")
-                    return source
-
-                line = modified_lines[insert_line]
-
-                # Логика добавления пробелов при вставке
-                prev_char = line[insert_column - 1] if insert_column > 0 else ''
-                patch_start = patch[0] if patch else ''
-                next_char = line[insert_column] if insert_column < len(line) else ''
-                patch_end = patch[-1] if patch else ''
-
-                # Добавляем пробел, если патч "сливается" с окружающим текстом
-                space_before = prev_char.isalnum() and patch_start.isalnum()
-                space_after = patch_end.isalnum() and next_char.isalnum()
-
-                # Собираем новую строку с учетом пробелов
-                new_line = (
-                        line[:insert_column] +
-                        (' ' if space_before else '') +
-                        patch +
-                        (' ' if space_after else '') +
-                        line[insert_column:]
-                )
-                modified_lines[insert_line] = new_line
-            else:
-
-                # Вставка на новой строке с выравниванием отступов
-                if insert_line < len(modified_lines):
-                    current_line = modified_lines[insert_line]
-
-                    # Определяем отступ текущей строки
-                    current_indent = ' ' * (len(current_line) - len(current_line.lstrip()))
-
-                    # Определяем отступ следующей строки (для блоков кода)
-                    next_line_num = insert_line + 1
-                    next_indent = current_indent
-                    if next_line_num < len(modified_lines):
-                        next_line = modified_lines[next_line_num]
-                        next_indent = ' ' * (len(next_line) - len(next_line.lstrip()))
-
-                    # Если текущая строка заканчивается на '{', используем отступ следующей строки
-                    if current_line.rstrip().endswith('{'):
-                        indent = next_indent
-                    else:
-                        indent = current_indent
+    def _remove_stale_socket(self):
+        """Удаление файла сокета, оставшегося от завершившегося сервера"""
+        import socket
 
-                    # Вставляем патч с правильным отступом
-                    modified_lines.insert(insert_line + 1, indent + patch.strip())
-                else:
-                    modified_lines.append(patch)    # Если вставка в конец файла
-        print("\n[DEBUG] Modified code:")
-        print('\n'.join(modified_lines))
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"Server is already running on {self.socket_path}")
+        finally:
+            probe.close()
+
+    async def serve(self):
+        """Прием соединений до SIGINT/SIGTERM"""
+        import asyncio
+        import signal
+
+        self._remove_stale_socket()
+        server = await asyncio.start_unix_server(self._serve_client, path=self.socket_path,
+                                                 limit=DAEMON_MAX_REQUEST)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def run(self):
+        import asyncio
+
+        asyncio.run(self.serve())
+
+
+def daemon_request(socket_path, request, timeout=None):
+    """Отправка одного запроса серверу PatchServer и получение ответа (для клиентов на Python)"""
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+        with client.makefile('rb') as stream:
+            return json.loads(stream.readline())
+
+
+def build_parser():
+    """Парсер аргументов командной строки"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="Interpreter.py",
+        description="MarkPatch: применение патчей из Markdown-файлов. Без команды запускается GUI."
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    apply_cmd = commands.add_parser("apply", help="пакетное применение патчей без GUI")
+    apply_cmd.add_argument("inputs", nargs="+", help="файлы .md, каталоги или glob-шаблоны")
+    apply_cmd.add_argument("-j", "--jobs", type=int, default=None,
+                           help="число процессов (по умолчанию — число ядер)")
+    apply_cmd.add_argument("-o", "--output-dir", default=None,
+                           help="каталог для результатов (по умолчанию — рядом с документами)")
+    apply_cmd.add_argument("--chunksize", type=int, default=None,
+                           help="число документов в одной задаче пула")
+    apply_cmd.add_argument("--summary", default="-",
+                           help="файл для JSON-сводки ('-' — стандартный вывод)")
+    apply_cmd.add_argument("--trace", default=None, metavar="PATH",
+                           help="файл для трассировки в формате JSON Lines ('-' — stderr)")
+    apply_cmd.add_argument("--trace-level", choices=sorted(TRACE_LEVELS, key=TRACE_LEVELS.get), default="info",
+                           help="подробность трассировки (по умолчанию info)")
+    apply_cmd.add_argument("--cache", default=None, metavar="PATH",
+                           help="база sqlite для дискового кэша результатов (общая для запусков)")
+    apply_cmd.add_argument("--cache-size", type=int, default=RESULT_CACHE_DISK_BYTES // (1024 * 1024), metavar="MB",
+                           help="предельный объем дискового кэша в МБ")
+    apply_cmd.add_argument("--no-cache", action="store_true",
+                           help="не кэшировать результаты поиска")
+    apply_cmd.add_argument("--diff", action="store_true",
+                           help="записывать unified diff изменений (*.diff) вместо результатов")
+    apply_cmd.add_argument("--match", choices=MATCH_MODES, default=MATCH_TEXT,
+                           help="сопоставление по тексту или по лексемам без учета пробелов (по умолчанию text)")
+    apply_cmd.add_argument("--in-place", action="store_true",
+                           help="атомарно заменять внешние исходные файлы (Source path) результатом")
+    apply_cmd.add_argument("--watch", action="store_true",
+                           help="после применения следить за документами и их исходными файлами "
+                                "и применять заново при изменении (JSON-строка на применение)")
+    apply_cmd.add_argument("--debounce", type=int, default=int(WATCH_DEBOUNCE * 1000), metavar="MS",
+                           help="сколько файл не должен меняться перед повторным применением, мс")
+
+    serve_cmd = commands.add_parser("serve", help="сервер применения патчей на Unix-сокете")
+    serve_cmd.add_argument("--socket", required=True, metavar="PATH", help="путь к Unix-сокету")
+    serve_cmd.add_argument("-j", "--jobs", type=int, default=None,
+                           help="число потоков обработки (по умолчанию — число ядер)")
+    serve_cmd.add_argument("--cache", default=None, metavar="PATH",
+                           help="база sqlite для дискового кэша результатов")
+    serve_cmd.add_argument("--cache-size", type=int, default=RESULT_CACHE_DISK_BYTES // (1024 * 1024), metavar="MB",
+                           help="предельный объем дискового кэша в МБ")
+    serve_cmd.add_argument("--trace", default=None, metavar="PATH",
+                           help="файл для трассировки в формате JSON Lines ('-' — stderr)")
+    serve_cmd.add_argument("--trace-level", choices=sorted(TRACE_LEVELS, key=TRACE_LEVELS.get), default="info",
+                           help="подробность трассировки (по умолчанию info)")
+    return parser
+
+
+def run_apply(args):
+    """Команда apply: пакетная обработка и вывод JSON-сводки или режим наблюдения"""
+    paths = collect_documents(args.inputs)
+    if args.watch:
+        _init_worker(args.trace, TRACE_LEVELS[args.trace_level], args.cache, args.cache_size * 1024 * 1024,
+                     not args.no_cache)
+        return run_watch(paths, output_dir=args.output_dir, diff=args.diff, mode=args.match,
+                         debounce=args.debounce / 1000)
+    summary = run_batch(paths, jobs=args.jobs, output_dir=args.output_dir, chunksize=args.chunksize,
+                        trace_path=args.trace, trace_level=TRACE_LEVELS[args.trace_level],
+                        cache_path=args.cache, cache_bytes=args.cache_size * 1024 * 1024,
+                        cache_enabled=not args.no_cache, diff=args.diff, in_place=args.in_place,
+                        mode=args.match)
+
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary == "-":
+        print(text)
+    else:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    return 0 if summary[STATUS_APPLIED] == summary["total"] else 1
+
+
+def run_serve(args):
+    """Команда serve: запуск сервера до SIGINT/SIGTERM"""
+    setup_trace(args.trace, TRACE_LEVELS[args.trace_level])
+    setup_cache(args.cache, args.cache_size * 1024 * 1024)
+    PatchServer(args.socket, workers=args.jobs).run()
+    return 0
+
+
+def run_gui():
+    """
+    Запуск графического интерфейса (tkinter импортируется только здесь).
+
+    Если установлен необязательный пакет tkinterdnd2, файлы можно
+    перетаскивать в окно.
+    """
+    global tk, filedialog, scrolledtext, ttk
+    import tkinter as tk
+    from tkinter import filedialog, scrolledtext, ttk
+
+    try:
+        from tkinterdnd2 import DND_FILES, TkinterDnD
+    except ImportError:
+        root, dnd_files = tk.Tk(), None
+    else:
+        root, dnd_files = TkinterDnD.Tk(), DND_FILES
+    app = PatchApp(root, dnd_files=dnd_files)
+    root.mainloop()
+
+
+def main(argv=None):
+    """Точка входа: команды apply и serve или графический интерфейс"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "apply" and args.watch and args.in_place:
+        # Замененный исходный файл снова вызвал бы применение тех же пар
+        parser.error("--watch cannot be combined with --in-place")
+    if args.command == "apply":
+        return run_apply(args)
+    if args.command == "serve":
+        return run_serve(args)
+    run_gui()
+    return 0
 
-        return '\n'.join(modified_lines)    # Возвращаем модифицированный код
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = PatchApp(root)
-    root.mainloop()
\ No newline at end of file
+    sys.exit(main())
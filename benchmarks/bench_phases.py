@@ -0,0 +1,237 @@
+"""
+Замер производительности по фазам обработки документа.
+
+Фазы:
+- parse    — разбор Markdown-документа (parse_document, секции и пары);
+- tokenize — компиляция шаблонов (compile_pattern без LRU-кэша);
+- match    — поиск мест применения всех пар (plan_edits без кэша результатов);
+- apply    — сборка результата из правок (apply_edits).
+
+Документы генерируются детерминированно (random.Random(seed)):
+большой C++-подобный исходный код, шаблоны с длинными цепочками wildcard,
+много пар в одном документе и почти совпадающие «приманки» перед целью.
+Для каждой фазы берется минимальное время из --repeat запусков (после
+прогревочного, со сборщиком мусора выключенным, как в timeit) и пиковый
+объем памяти (tracemalloc, отдельным запуском, чтобы не искажать время).
+
+Результаты сравниваются с сохраненной базой (benchmarks/baseline.json):
+фаза, время которой выросло больше чем на --threshold, считается
+регрессией. Запуск:
+    python benchmarks/bench_phases.py                  # сравнение с базой
+    python benchmarks/bench_phases.py --save-baseline  # обновление базы
+Код возврата 1, если найдена регрессия.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markpatch import apply_edits, compile_pattern, parse_document, plan_edits  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PHASES = ("parse", "tokenize", "match", "apply")
+
+TYPES = ["int", "double", "bool", "std::string", "std::vector<int>", "Node*"]
+
+
+def cpp_source(rnd, classes, methods=6):
+    """C++-подобный исходный код: классы с полями, методами и комментариями"""
+    parts = ['#include <string>\n#include <vector>\n\nnamespace app {\n\n']
+    for c in range(classes):
+        parts.append(f"// Class{c}: generated for benchmarks\nclass Class{c} : public Base {{\n  public:\n")
+        for m in range(methods):
+            args = ', '.join(f"{rnd.choice(TYPES)} a{k}" for k in range(rnd.randint(0, 3)))
+            parts.append(f"    {rnd.choice(TYPES)} method{c}_{m}({args});\n")
+        parts.append("  private:\n")
+        for f in range(rnd.randint(1, 4)):
+            parts.append(f"    {rnd.choice(TYPES)} field{c}_{f};\n")
+        parts.append("};\n\n")
+    parts.append("}  // namespace app\n")
+    return ''.join(parts)
+
+
+def make_document(source, hunks):
+    """Markdown-документ MarkPatch из исходного кода и пар (match, patch)"""
+    parts = ["# Benchmark\n\n## Source file\n```cpp\n", source, "```\n"]
+    for match, patch in hunks:
+        parts += ["\n### match:\n```\n", match, "\n```\n\n### patch\n```\n", patch, "\n```\n"]
+    return ''.join(parts)
+
+
+def _insert_hunk(c, m):
+    return f"class Class{c} ... {{ ... >>> method{c}_{m}(", "virtual"
+
+
+def large_source(rnd):
+    """Большой исходный код (~1 МБ), несколько пар"""
+    classes = 4000
+    source = cpp_source(rnd, classes)
+    hunks = [_insert_hunk(c, rnd.randrange(6)) for c in sorted(rnd.sample(range(classes), 5))]
+    return make_document(source, hunks)
+
+
+def deep_wildcards(rnd):
+    """Шаблоны с длинными цепочками wildcard через много классов"""
+    classes = 1000
+    source = cpp_source(rnd, classes)
+    hunks = []
+    for start in sorted(rnd.sample(range(0, classes - 40, 40), 10)):
+        chain = ' ... '.join(f"class Class{c}" for c in range(start, start + 30))
+        hunks.append((f"{chain} ... {{ >>>", f"int marker{start};"))
+    return make_document(source, hunks)
+
+
+def many_hunks(rnd):
+    """Много пар (500) в одном документе"""
+    classes = 2000
+    source = cpp_source(rnd, classes)
+    hunks = [_insert_hunk(c, rnd.randrange(6)) for c in sorted(rnd.sample(range(classes), 500))]
+    return make_document(source, hunks)
+
+
+def near_miss(rnd):
+    """Почти совпадающие «приманки» перед каждой целью"""
+    decoy = "class Target : public Base {\n    void handle(int a);\n    void handler_old();\n};\n"
+    parts = []
+    for t in range(20):
+        parts.append(decoy * 200)
+        parts.append(f"class Target{t} : public Base {{\n    void handle(int a);\n    void handlerX{t}();\n}};\n")
+    source = cpp_source(rnd, 50) + ''.join(parts)
+    hunks = [(f"class Target{t} ... {{ ... void handle( ... >>> void handlerX{t}(", "virtual") for t in range(20)]
+    return make_document(source, hunks)
+
+
+WORKLOADS = [
+    ("large-source", large_source),
+    ("deep-wildcards", deep_wildcards),
+    ("many-hunks", many_hunks),
+    ("near-miss", near_miss),
+]
+
+
+def run_phases(content):
+    """Однократное выполнение всех фаз: {фаза: секунды}"""
+    timings = {}
+    started = time.perf_counter()
+    document = parse_document(content)
+    source = document.section("Source file")
+    hunks = document.hunks()
+    timings["parse"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    compiled = [(compile_pattern.__wrapped__(match), patch) for match, patch in hunks]
+    timings["tokenize"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    edits = plan_edits(source, compiled, strict=True, cache=False)
+    timings["match"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    apply_edits(source, edits)
+    timings["apply"] = time.perf_counter() - started
+    return timings
+
+
+def peak_memory(content):
+    """Пиковый объем памяти (байт) при обработке документа"""
+    tracemalloc.start()
+    try:
+        run_phases(content)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(seed, repeat):
+    """Замер всех нагрузок: {нагрузка: {фаза_ms: ..., peak_kb: ..., size_kb: ...}}"""
+    results = {}
+    for name, generate in WORKLOADS:
+        content = generate(random.Random(seed))
+        best = dict.fromkeys(PHASES, float('inf'))
+        run_phases(content)     # Прогрев: выделение памяти, кэш шаблонов регулярных выражений
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                timings = run_phases(content)
+            finally:
+                gc.enable()
+            for phase, seconds in timings.items():
+                best[phase] = min(best[phase], seconds)
+        entry = {f"{phase}_ms": round(best[phase] * 1000, 3) for phase in PHASES}
+        entry["peak_kb"] = peak_memory(content) // 1024
+        entry["size_kb"] = len(content) // 1024
+        results[name] = entry
+    return results
+
+
+def compare(results, baseline, threshold, min_ms):
+    """Сравнение с базой: список описаний регрессий"""
+    regressions = []
+    for name, entry in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, value in entry.items():
+            if key not in base or key == "size_kb":
+                continue
+            old = base[key]
+            # Очень короткие фазы не сравниваются: шум измерения больше разницы
+            if key.endswith("_ms") and max(old, value) < min_ms:
+                continue
+            if value > old * (1 + threshold):
+                regressions.append(f"{name}.{key}: {old} -> {value} (+{(value / old - 1) * 100 if old else 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замер производительности по фазам")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=7, help="число запусков (берется минимум)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="файл базы для сравнения")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результаты как базу")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимый рост (0.25 = 25%%)")
+    parser.add_argument("--min-ms", type=float, default=5.0, help="фазы короче не сравниваются")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в формате JSON")
+    args = parser.parse_args(argv)
+
+    results = measure(args.seed, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        header = ''.join(f"{phase + ' ms':>12s}" for phase in PHASES)
+        print(f"{'workload':16s}{header}{'peak KB':>10s}{'size KB':>10s}")
+        for name, entry in results.items():
+            phases = ''.join(f"{entry[phase + '_ms']:12.3f}" for phase in PHASES)
+            print(f"{name:16s}{phases}{entry['peak_kb']:10d}{entry['size_kb']:10d}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({"seed": args.seed, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline, run with --save-baseline")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get("seed") != args.seed:
+        print(f"baseline was recorded with seed {baseline.get('seed')}, comparison skipped")
+        return 0
+    regressions = compare(results, baseline["results"], args.threshold, args.min_ms)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    print(f"{len(regressions)} regressions (threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
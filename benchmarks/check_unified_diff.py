@@ -0,0 +1,101 @@
+"""
+Проверка unified diff (unified_diff) внешними утилитами применения патчей.
+
+На случайных коротких исходниках строятся случайные наборы правок
+(вставки, замены и удаления, в том числе переводов строк и текста
+без перевода строки в конце файла) со случайным числом строк контекста.
+Diff применяется к копии исходного кода утилитами `patch -p1`
+и `git apply` (те, что установлены; diff без строк контекста git
+принимает только с --unidiff-zero), и результат сравнивается
+с apply_edits. Пустой diff должен получаться только для правок,
+не меняющих текст.
+
+Запуск: python benchmarks/check_unified_diff.py [--seed N] [--cases N]
+Код возврата 1, если найдено расхождение.
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markpatch import Edit, apply_edits, unified_diff  # noqa: E402
+
+NAME = "source"     # Имя файла в заголовках diff (a/source, b/source)
+
+# Команды применения diff из каталога с файлом NAME
+TOOLS = {
+    "patch": ["patch", "-s", "--no-backup-if-mismatch", "-p1"],
+    "git apply": ["git", "apply", "-p1"],
+}
+
+
+def random_case(rnd):
+    """Исходный код и упорядоченные непересекающиеся правки"""
+    source = ''.join(rnd.choice(['a', 'b', '\n', '\n', 'cd ', 'x']) for _ in range(rnd.randint(0, 40)))
+    count = rnd.randint(0, 4)
+    points = sorted(rnd.randint(0, len(source)) for _ in range(2 * count))
+    edits = []
+    for i in range(count):
+        start = points[2 * i]
+        end = points[2 * i + 1] if rnd.random() < 0.6 else start
+        edits.append(Edit(start, end, rnd.choice(['', 'Q', 'Z\n', '\nW', 'R\nS\n'])))
+    return source, edits
+
+
+def apply_with(tool, directory, source, diff, context):
+    """Результат применения diff утилитой (None, если утилита сообщила об ошибке)"""
+    path = os.path.join(directory, NAME)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(source)
+    command = TOOLS[tool] + (["--unidiff-zero"] if tool == "git apply" and not context else [])
+    result = subprocess.run(command, cwd=directory, input=diff, text=True, capture_output=True)
+    if result.returncode:
+        return None
+    with open(path, encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка unified diff утилитами patch и git apply")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", type=int, default=400)
+    args = parser.parse_args(argv)
+
+    tools = [tool for tool, command in TOOLS.items() if shutil.which(command[0])]
+    if not tools:
+        print("neither patch nor git found, check skipped")
+        return 0
+
+    rnd = random.Random(args.seed)
+    failures = dict.fromkeys(tools, 0)
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(args.cases):
+            source, edits = random_case(rnd)
+            expected = apply_edits(source, edits)
+            context = rnd.randint(0, 3)
+            diff = unified_diff(source, edits, NAME, context=context)
+            if not diff:
+                if expected != source:
+                    for tool in tools:
+                        failures[tool] += 1
+                    print(f"EMPTY DIFF source={source!r} edits={edits}")
+                continue
+            for tool in tools:
+                actual = apply_with(tool, directory, source, diff, context)
+                if actual != expected:
+                    failures[tool] += 1
+                    if failures[tool] <= 3:
+                        print(f"MISMATCH ({tool}) source={source!r} edits={edits}\n{diff}"
+                              f"  expected={expected!r}\n  actual={actual!r}")
+    for tool in tools:
+        print(f"{tool}: {args.cases} cases, {failures[tool]} mismatches")
+    return 1 if any(failures.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
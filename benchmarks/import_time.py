@@ -0,0 +1,65 @@
+"""
+Проверка времени импорта ядра и модулей, загружаемых при импорте.
+
+1. `import markpatch` и `import Interpreter` не должны загружать tkinter
+   и тяжелые модули командной строки (FORBIDDEN): они импортируются
+   только при запуске GUI, пакетного режима или сервера.
+2. Время импорта markpatch (по -X importtime, минимум из --repeat
+   запусков в отдельных процессах) не должно превышать --budget мс.
+
+Запуск: python benchmarks/import_time.py [--budget MS] [--repeat N]
+Код возврата 1, если проверка не пройдена.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORBIDDEN = ("tkinter", "argparse", "glob", "logging", "multiprocessing", "concurrent.futures",
+             "asyncio", "sqlite3", "socket")
+
+
+def loaded_modules(module):
+    """Модули, загруженные при импорте module в чистом процессе"""
+    code = (f"import sys, json; before = set(sys.modules); import {module}; "
+            f"print(json.dumps(sorted(set(sys.modules) - before)))")
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+    return json.loads(output)
+
+
+def import_time_ms(module):
+    """Суммарное время импорта module (с зависимостями) по -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        # Формат: "import time: self [us] | cumulative | imported package"
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"{module} not found in -X importtime output")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка времени импорта ядра MarkPatch")
+    parser.add_argument("--budget", type=float, default=30.0, help="предельное время импорта markpatch, мс")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    ok = True
+    for module in ("markpatch", "Interpreter"):
+        loaded = loaded_modules(module)
+        heavy = [name for name in loaded if name.split('.')[0] in FORBIDDEN or name in FORBIDDEN]
+        print(f"import {module}: {len(loaded)} modules loaded" + (f", FORBIDDEN: {heavy}" if heavy else ""))
+        ok = ok and not heavy
+
+    best = min(import_time_ms("markpatch") for _ in range(args.repeat))
+    verdict = "ok" if best <= args.budget else "SLOW"
+    print(f"import markpatch: {best:.1f} ms (budget {args.budget:.0f} ms) {verdict}")
+    return 0 if ok and verdict == "ok" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
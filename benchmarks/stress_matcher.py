@@ -0,0 +1,256 @@
+"""
+Нагрузочная проверка движка сопоставления шаблонов (match_spans).
+
+1. Корректность: на случайных коротких исходниках результат сравнивается
+   с полным перебором всех вхождений шаблона (первое вхождение —
+   с самым ранним концом, среди них — с самым поздним началом).
+   Фрагменты, разделенные маркерами (>>>, <<<), как и разделенные
+   wildcard, могут находиться где угодно дальше по тексту; это же
+   проверяется на примерах применения патчей (MARKER_CASES).
+2. Линейность: на враждебных входах (много ложных кандидатов, почти
+   совпадающие «приманки», длинные цепочки wildcard) время при увеличении
+   исходного кода в SCALE раз должно расти не быстрее чем в SCALE * SLACK раз.
+
+Запуск: python benchmarks/stress_matcher.py [--seed N] [--cases N]
+Код возврата 1, если найдено расхождение или нелинейный рост времени.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markpatch  # noqa: E402
+from markpatch import (BlockSearcher, SourceIndex, TokenSearcher, TokenStream, Tracer,  # noqa: E402
+                       apply_patch, compile_pattern, encode_pattern, find_edit, match_spans)
+
+SCALE = 4       # Во сколько раз увеличивается исходный код во втором замере
+SLACK = 2.5     # Допустимое отклонение от линейного роста
+
+
+def tight_literals(compiled):
+    """
+    Индексы фрагментов, которые следуют вплотную за предыдущим: между ними
+    нет wildcard и маркеров. Вычисляются по токенам шаблона, независимо
+    от разбиения на группы в compile_pattern
+    """
+    tight = set()
+    idx = 0
+    joined = False
+    for kind, value in compiled.tokens:
+        if kind != 'text':
+            joined = False
+            continue
+        for _ in markpatch._LINE_BREAK_RE.split(value):
+            if joined:
+                tight.add(idx)
+            joined = True
+            idx += 1
+    return tight
+
+
+def reference_spans(source, compiled):
+    """Полный перебор вхождений (экспоненциален, только для коротких входов)"""
+    literals = compiled.literals
+    tight = tight_literals(compiled)
+    best = None
+
+    def walk(idx, pos, starts):
+        nonlocal best
+        if idx == len(literals):
+            spans = [(s, s + len(literals[i])) for i, s in enumerate(starts)]
+            key = (spans[-1][1] if spans else 0, -(spans[0][0] if spans else 0), starts)
+            if best is None or key < best[0]:
+                best = (key, spans)
+            return
+        literal = literals[idx]
+        if idx in tight:
+            gap_end = pos
+            while gap_end < len(source) and source[gap_end].isspace():
+                gap_end += 1
+            candidates = [gap_end] if source.startswith(literal, gap_end) else []
+        else:
+            candidates = []
+            found = source.find(literal, pos)
+            while found != -1:
+                candidates.append(found)
+                found = source.find(literal, found + 1)
+        for start in candidates:
+            walk(idx + 1, start + len(literal), starts + (start,))
+
+    walk(0, 0, ())
+    return None if best is None else best[1]
+
+
+def token_reference_spans(stream, compiled):
+    """
+    Полный перебор для режима лексем: каждая лексема заменяется одним
+    символом, поэтому вхождения ищутся в строке без пробелов
+    """
+    text = ''.join(chr(0x4E00 + token) for token in stream.ids)
+    literals = tuple(''.join(chr(0x4E00 + token) if token >= 0 else '\0' for token in stream.lex(literal))
+                     for literal in compiled.literals)
+    return reference_spans(text, compiled._replace(literals=literals))
+
+
+def _byte_offset(source, offset):
+    """Смещение в байтах UTF-8 для смещения в символах"""
+    return len(source[:offset].encode())
+
+
+def _apply(source, edit):
+    """Результат правки строкой (для байтового исходного кода — декодированный)"""
+    text = edit.text if isinstance(source, str) else edit.text.encode()
+    result = source[:edit.start] + text + source[edit.end:]
+    return result if isinstance(result, str) else result.decode()
+
+
+def check_correctness(rnd, cases, indexed=False, encoded=False, tokens=False):
+    """
+    Сравнение match_spans (без индекса, с SourceIndex, по байтовому
+    исходному коду или по потоку лексем) с полным перебором.
+
+    Байтовый исходный код проверяется с многобайтовыми символами UTF-8:
+    смещения перебора переводятся в байты, а правка find_edit (включая
+    пробелы вокруг вставки) сравнивается с правкой для строки.
+    """
+    alphabet = ['a', 'b', 'ab', 'ba', ' ', '\n', '{', '}']
+    fragments = ['a', 'b', 'ab', 'ba', '{', '}', 'a b', '...', '...']
+    if encoded:
+        alphabet += ['é', 'я', 'éя', '(']
+        fragments += ['é', 'я é', '(']
+    failures = 0
+    for _ in range(cases):
+        source = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 30)))
+        pieces = []
+        for _ in range(rnd.randint(1, 5)):
+            pieces.append(rnd.choice(fragments))
+        marker = rnd.randint(0, len(pieces))
+        pieces.insert(marker, '>>>')
+        if rnd.random() < 0.3:      # Замена: фрагменты вокруг <<< тоже не обязаны идти подряд
+            pieces.insert(rnd.randint(marker + 1, len(pieces)), '<<<')
+        pattern = ' '.join(pieces)
+        compiled = compile_pattern(pattern)
+        if tokens:      # Позиции — номера лексем
+            stream = TokenStream(source)
+            searcher = TokenSearcher(stream, compiled, Tracer())
+            expected = token_reference_spans(stream, compiled)
+            actual = match_spans(searcher, searcher.pattern)
+            if expected != actual:
+                failures += 1
+                if failures <= 5:
+                    print(f"MISMATCH pattern={pattern!r} source={source!r}\n  expected={expected}\n  actual={actual}")
+            continue
+        expected = reference_spans(source, compiled)
+        index = SourceIndex(source) if indexed else None
+        if encoded:
+            if expected is not None:
+                expected = [(_byte_offset(source, start), _byte_offset(source, end)) for start, end in expected]
+            searched = encode_pattern(compiled)
+            actual = match_spans(BlockSearcher(source.encode(), searched, Tracer()), searched)
+            patch = rnd.choice(['x y', 'é', '}'])
+            if expected == actual and actual is not None and compiled.marker_index is not None:
+                expected = _apply(source, find_edit(source, compiled, patch, Tracer()))
+                actual = _apply(source.encode(), find_edit(source.encode(), compiled, patch, Tracer()))
+        else:
+            actual = match_spans(BlockSearcher(source, compiled, Tracer(), index), compiled)
+        if expected != actual:
+            failures += 1
+            if failures <= 5:
+                print(f"MISMATCH pattern={pattern!r} source={source!r}\n  expected={expected}\n  actual={actual}")
+    mode = ' (indexed)' if indexed else ' (bytes)' if encoded else ' (tokens)' if tokens else ''
+    print(f"correctness{mode}: {cases} cases, {failures} mismatches")
+    return failures == 0
+
+
+# Фрагменты по разные стороны маркера не обязаны идти подряд:
+# (исходный код, шаблон, патч, ожидаемый результат apply_patch)
+MARKER_CASES = [
+    ("class A {\n public:\n  void func();\n};", "class A { >>> void func", "virtual",
+     "class A {\n public:\n  virtual void func();\n};"),
+    ("foo x\nline\n  bar;\n", "foo >>> bar <<<", "baz", "foo x\nline\n  baz;\n"),
+    ("void f() {\n  int a;\n  return a;\n}", "void f() { >>> return", "x = 1;",
+     "void f() {\n  int a;\n  x = 1;return a;\n}"),
+]
+
+
+def check_markers():
+    """Применение патчей с фрагментами, разделенными маркерами, в текстовом и байтовом исходном коде"""
+    failures = 0
+    for source, pattern, patch, expected in MARKER_CASES:
+        actual = apply_patch(source, pattern, patch)
+        edit = find_edit(source.encode(), pattern, patch)
+        encoded = source.encode()
+        actual_bytes = (encoded[:edit.start] + edit.text.encode() + encoded[edit.end:]).decode()
+        for result in (actual, actual_bytes):
+            if result != expected:
+                failures += 1
+                print(f"MISMATCH pattern={pattern!r}\n  expected={expected!r}\n  actual={result!r}")
+    print(f"marker cases: {len(MARKER_CASES)} cases, {failures} mismatches")
+    return failures == 0
+
+
+def _time_match(source, pattern):
+    compiled = compile_pattern(pattern)
+    started = time.perf_counter()
+    match_spans(BlockSearcher(source, compiled, Tracer()), compiled)
+    return time.perf_counter() - started
+
+
+# Враждебные входы: (название, генератор исходного кода по размеру n, шаблон)
+ADVERSARIAL = [
+    ("no final token", lambda n: "a" * n, "a ... a ... a ... a >>> b"),
+    ("tight block decoys", lambda n: "x " * n + "x y", "x x x x x >>> y"),
+    ("near-miss decoys", lambda n: "class A { void f" * n + "class A { void func(", "class A ... { ... >>> void func("),
+    ("late anchor", lambda n: ("class A {\n" + "  int x;\n" * 4) * n + "void func(",
+     "class A ... { ... >>> void func("),
+    ("backward decoys", lambda n: "x y" + " y" * n + " z", "x\ny ... >>> z"),
+    ("deep wildcards", lambda n: "ab" * n, " ... ".join(["ab"] * 30) + " >>> ... ac"),
+]
+
+
+def check_linearity(size):
+    """Замер времени на враждебных входах размера size и size * SCALE"""
+    ok = True
+    for name, make_source, pattern in ADVERSARIAL:
+        small = min(_time_match(make_source(size), pattern) for _ in range(3))
+        large = min(_time_match(make_source(size * SCALE), pattern) for _ in range(3))
+        ratio = large / small if small > 0 else 0.0
+        verdict = "ok" if ratio <= SCALE * SLACK else "NONLINEAR"
+        ok = ok and verdict == "ok"
+        print(f"{name:20s} n={size:>7d}: {small * 1000:8.2f} ms  n={size * SCALE:>7d}: "
+              f"{large * 1000:8.2f} ms  x{ratio:5.2f}  {verdict}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка движка сопоставления")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", type=int, default=3000)
+    parser.add_argument("--size", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    correct = check_correctness(random.Random(args.seed), args.cases)
+    correct = check_correctness(random.Random(args.seed), args.cases, indexed=True) and correct
+    correct = check_correctness(random.Random(args.seed), args.cases, encoded=True) and correct
+    correct = check_correctness(random.Random(args.seed), args.cases, tokens=True) and correct
+    correct = check_markers() and correct
+    # Обратный поиск через регулярное выражение и неиндексируемые частые фрагменты
+    # проверяются отдельно
+    probes, markpatch.RSEARCH_PROBES = markpatch.RSEARCH_PROBES, 0
+    occurrences, markpatch.INDEX_MAX_OCCURRENCES = markpatch.INDEX_MAX_OCCURRENCES, 2
+    try:
+        correct = check_correctness(random.Random(args.seed), args.cases) and correct
+        correct = check_correctness(random.Random(args.seed), args.cases, indexed=True) and correct
+        correct = check_correctness(random.Random(args.seed), args.cases, encoded=True) and correct
+    finally:
+        markpatch.RSEARCH_PROBES = probes
+        markpatch.INDEX_MAX_OCCURRENCES = occurrences
+    linear = check_linearity(args.size)
+    return 0 if correct and linear else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
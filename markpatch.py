@@ -0,0 +1,1858 @@
+"""
+MarkPatch: ядро применения патчей из Markdown-документов.
+
+Модуль не зависит от графического интерфейса и импортирует только легкие
+модули стандартной библиотеки, поэтому подходит для использования из кода
+и для быстрого запуска без GUI. Графический интерфейс, пакетный режим
+и сервер находятся в Interpreter.py.
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from itertools import accumulate
+from time import perf_counter, time
+
+# Максимальное число скомпилированных шаблонов в LRU-кэше
+PATTERN_CACHE_SIZE = 512
+
+# Число кандидатов, проверяемых при обратном поиске до перехода на регулярное выражение
+RSEARCH_PROBES = 16
+
+# SourceIndex: фрагменты с большим числом вхождений не индексируются,
+# индекс строится автоматически для документов с большим числом пар
+INDEX_MAX_OCCURRENCES = 4096
+INDEX_MIN_HUNKS = 8
+
+# Версия движка сопоставления входит в ключ кэша результатов:
+# увеличивается при любом изменении семантики поиска и вставки
+ENGINE_VERSION = 2
+
+# Кэш результатов: число записей в памяти и объем дискового уровня
+RESULT_CACHE_SIZE = 4096
+RESULT_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
+# Режимы сопоставления шаблона: по тексту фрагментов или по последовательностям лексем
+MATCH_TEXT = "text"
+MATCH_TOKENS = "tokens"
+MATCH_MODES = (MATCH_TEXT, MATCH_TOKENS)
+
+# Число строк контекста вокруг изменений в unified diff
+DIFF_CONTEXT = 3
+
+# Размер порции при потоковой записи результата (write_edits)
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+# Специальные последовательности языка шаблонов: wildcard и маркеры
+_SPECIAL_RE = re.compile(r'(\.\.\.|>>>|<<<)')
+_SPECIAL_TOKENS = {'...': 'wildcard', '>>>': 'marker', '<<<': 'end_replace'}
+_SPECIAL_TEXT = {kind: text for text, kind in _SPECIAL_TOKENS.items()}
+_NEWLINE_RE = re.compile('\n')
+_LINE_BREAK_RE = re.compile(r'\s*\n\s*')     # Перевод строки с окружающими отступами
+_WORD_RE = re.compile(r'\w+')
+_TOKEN_RE = re.compile(r'(\w+|[^\w\s])')   # Лексема: слово или один знак (группа — для re.split)
+
+
+# Уровни трассировки: чем выше уровень, тем подробнее события
+TRACE_OFF = 0
+TRACE_INFO = 1      # начало применения, замена, вставка, несовпадение
+TRACE_DEBUG = 2     # токенизация шаблона и найденные совпадения
+TRACE_VERBOSE = 3   # промахи поиска токенов
+TRACE_LEVELS = {"off": TRACE_OFF, "info": TRACE_INFO, "debug": TRACE_DEBUG, "verbose": TRACE_VERBOSE}
+_TRACE_LEVEL_NAMES = {level: name for name, level in TRACE_LEVELS.items()}
+
+
+class TraceEvent(namedtuple('TraceEvent', 'kind level fields')):
+    """Событие трассировки: тип (tokenize, match, miss, replace, insert...), уровень и данные"""
+    __slots__ = ()
+
+    def __str__(self):
+        details = ' '.join(f"{key}={value!r}" for key, value in self.fields.items())
+        return f"[{self.kind.upper()}] {details}"
+
+    def to_dict(self):
+        """Представление события для JSON"""
+        record = {"event": self.kind, "level": _TRACE_LEVEL_NAMES.get(self.level, self.level)}
+        record.update(self.fields)
+        return record
+
+
+class NullSink:
+    """Приемник, отбрасывающий все события"""
+    def write(self, event):
+        pass
+
+
+class LoggingSink:
+    """Передача событий в модуль logging (форматирование — только при выводе записи)"""
+    def __init__(self, logger=None):
+        import logging     # Импортируется только при использовании приемника
+
+        self.logger = logger or logging.getLogger("markpatch")
+        self.levels = {TRACE_INFO: logging.INFO, TRACE_DEBUG: logging.DEBUG, TRACE_VERBOSE: logging.DEBUG}
+        self.default_level = logging.DEBUG
+
+    def write(self, event):
+        self.logger.log(self.levels.get(event.level, self.default_level), "%s", event)
+
+
+class JsonLinesSink:
+    """Запись событий в поток в формате JSON Lines (одна строка на событие)"""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, event):
+        self.stream.write(json.dumps(event.to_dict(), ensure_ascii=False) + "\n")
+
+
+class RingBufferSink:
+    """Кольцевой буфер последних событий в памяти (для GUI)"""
+    def __init__(self, capacity=1000):
+        self.events = deque(maxlen=capacity)
+
+    def write(self, event):
+        self.events.append(event)
+
+    def lines(self):
+        """Текстовое представление накопленных событий"""
+        return [str(event) for event in self.events]
+
+    def clear(self):
+        self.events.clear()
+
+
+class Tracer:
+    """
+    Трассировщик: отправляет события не выше заданного уровня в приемник.
+
+    В горячих участках кода поле level проверяется до формирования события,
+    поэтому выключенная трассировка не тратит время на форматирование.
+    """
+    __slots__ = ('sink', 'level')
+
+    def __init__(self, sink=None, level=TRACE_OFF):
+        self.sink = sink if sink is not None else NullSink()
+        self.level = level if sink is not None else TRACE_OFF
+
+    def emit(self, kind, level, **fields):
+        """Отправка события, если его уровень не превышает уровень трассировщика"""
+        if self.level >= level:
+            self.sink.write(TraceEvent(kind, level, fields))
+
+
+_tracer = Tracer()     # Глобальный трассировщик, по умолчанию выключен
+
+
+def get_tracer():
+    """Текущий глобальный трассировщик"""
+    return _tracer
+
+
+def set_tracer(tracer):
+    """Установка глобального трассировщика (None — выключить трассировку)"""
+    global _tracer
+    _tracer = tracer if tracer is not None else Tracer()
+
+
+class _Phase:
+    """Контекстный менеджер замера одной фазы (время суммируется при повторах)"""
+    __slots__ = ('phases', 'name', 'started')
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self.started
+        self.phases[self.name] = self.phases.get(self.name, 0.0) + elapsed
+        return False
+
+
+class _NullPhase:
+    """Пустой контекстный менеджер для выключенных замеров"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Metrics:
+    """
+    Время фаз обработки и счетчики одного запуска.
+
+    Фазы: read, parse, hash, cache, tokenize, match, assemble, write.
+    Счетчики: hunks, cache_hits, searches и probes (прямые и обратные
+    поиски групп фрагментов), scanned_chars (символы, просмотренные
+    регулярными выражениями), edits.
+    with metrics.phase(name) стоит двух вызовов perf_counter.
+    """
+    __slots__ = ('phases', 'counters')
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+
+    def phase(self, name):
+        """Контекстный менеджер замера фазы name"""
+        return _Phase(self.phases, name)
+
+    def count(self, name, value=1):
+        """Увеличение счетчика name"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        """Представление для JSON: время фаз в миллисекундах и счетчики"""
+        return {
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+    def summary(self):
+        """Краткая строка для строки состояния GUI"""
+        phases = '  '.join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in self.phases.items())
+        counters = '  '.join(f"{name}={value}" for name, value in self.counters.items())
+        total = sum(self.phases.values()) * 1000
+        return f"Total {total:.1f} ms | {phases} | {counters}"
+
+
+class NullMetrics:
+    """Выключенные замеры: фазы и счетчики не записываются"""
+    __slots__ = ()
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def count(self, name, value=1):
+        pass
+
+
+_metrics = NullMetrics()    # Глобальные замеры, по умолчанию выключены
+
+
+def get_metrics():
+    """Текущие глобальные замеры"""
+    return _metrics
+
+
+def set_metrics(metrics):
+    """Установка глобальных замеров (None — выключить)"""
+    global _metrics
+    _metrics = metrics if metrics is not None else NullMetrics()
+
+
+class CompiledPattern(namedtuple('CompiledPattern', 'text tokens literals blocks block_res marker_index '
+                                                    'marker_at replace_span anchor')):
+    """
+    Неизменяемый скомпилированный шаблон match:
+
+    text          — исходный текст шаблона
+    tokens        — кортеж токенов (тип, значение)
+    literals      — текстовые фрагменты в порядке следования (переводы строк
+                    внутри текста разбивают его на отдельные фрагменты)
+    blocks        — группы индексов literals, между которыми нет wildcard и маркеров:
+                    внутри группы фрагменты разделены только пробельными символами
+    block_res     — регулярные выражения групп (по захватывающей группе на фрагмент)
+    marker_index  — индекс маркера >>> в tokens (None, если маркера нет)
+    marker_at     — число фрагментов literals перед маркером
+    replace_span  — (первый, последний) индексы literals между >>> и <<<, иначе None
+    anchor        — первый фрагмент после маркера (ориентир вставки) или None
+    """
+    __slots__ = ()
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(match_pattern):
+    """
+    Компиляция шаблона в неизменяемый объект CompiledPattern.
+
+    Результат кэшируется по тексту шаблона (LRU), статистика попаданий
+    и промахов доступна через compile_pattern.cache_info().
+    """
+    tokens = []
+    # re.split с группой оставляет разделители (..., >>>, <<<) в списке
+    for piece in _SPECIAL_RE.split(match_pattern):
+        kind = _SPECIAL_TOKENS.get(piece)
+        if kind is not None:
+            tokens.append((kind, None))
+            continue
+        text = piece.strip()
+        if text:    # Пустые фрагменты и пробелы между токенами отбрасываются
+            tokens.append(('text', text))
+    tokens = tuple(tokens)
+
+    literals = []
+    blocks = []
+    block = []          # Текущая группа фрагментов без wildcard и маркеров между ними
+    marker_index = None
+    marker_at = None
+    replace_span = None
+    for idx, (p_type, p_val) in enumerate(tokens):
+        if p_type == 'text':
+            # Отступы и переводы строк внутри текста не обязаны совпадать буквально
+            for literal in _LINE_BREAK_RE.split(p_val):
+                block.append(len(literals))
+                literals.append(literal)
+            continue
+        # Wildcard и маркеры завершают группу: фрагменты по разные стороны
+        # от >>> и <<< могут находиться где угодно дальше по тексту
+        if block:
+            blocks.append(tuple(block))
+        block = []
+        if p_type == 'marker' and marker_index is None:
+            marker_index = idx
+            marker_at = len(literals)
+        elif p_type == 'end_replace' and marker_index is not None and replace_span is None:
+            # Замена: между >>> и <<< есть хотя бы один фрагмент
+            if len(literals) > marker_at:
+                replace_span = (marker_at, len(literals) - 1)
+    if block:
+        blocks.append(tuple(block))
+
+    anchor = None
+    if marker_at is not None and marker_at < len(literals):
+        anchor = literals[marker_at]
+
+    block_res = tuple(
+        re.compile(r'\s*'.join('(' + re.escape(literals[i]) + ')' for i in block))
+        for block in blocks
+    )
+    return CompiledPattern(match_pattern, tokens, tuple(literals), tuple(blocks), block_res,
+                           marker_index, marker_at, replace_span, anchor)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def encode_pattern(compiled):
+    """
+    Вариант шаблона для поиска в байтовом исходном коде (bytes, mmap).
+
+    Фрагменты кодируются в UTF-8, регулярные выражения групп строятся
+    над bytes, поэтому найденные смещения — смещения в байтах. Пробельными
+    между фрагментами считаются только пробельные символы ASCII.
+    """
+    literals = tuple(literal.encode('utf-8') for literal in compiled.literals)
+    block_res = tuple(
+        re.compile(rb'\s*'.join(b'(' + re.escape(literals[i]) + b')' for i in block))
+        for block in compiled.blocks
+    )
+    anchor = literals[compiled.marker_at] if compiled.anchor is not None else None
+    return compiled._replace(literals=literals, block_res=block_res, anchor=anchor)
+
+
+# Имена секций маркдаун-документа с патчем
+SOURCE_SECTION = "Source file"
+SOURCE_PATH_SECTION = "Source path"     # Путь к внешнему исходному файлу вместо Source file
+MATCH_SECTION = "match:"
+PATCH_SECTION = "patch"
+
+
+class Section(namedtuple('Section', 'title key header_offset start end')):
+    """
+    Секция маркдаун-документа
+
+    title          — текст заголовка без символов #
+    key            — нормализованный заголовок (для поиска без учета регистра)
+    header_offset  — смещение строки заголовка в документе
+    start, end     — границы содержимого блока кода (None, если блока нет)
+    """
+    __slots__ = ()
+
+
+class MarkdownDocument:
+    """Индекс маркдаун-документа: заголовки и смещения их блоков кода"""
+    def __init__(self, content, sections):
+        self.content = content
+        self.sections = sections
+        self._by_key = {}
+        for section in sections:    # Первая секция с таким заголовком имеет приоритет
+            self._by_key.setdefault(section.key, section)
+
+    def text(self, section):
+        """Содержимое блока кода секции (срез исходного документа)"""
+        if section is None or section.start is None or section.start == section.end:
+            return None
+        return self.content[section.start:section.end].strip()
+
+    def section(self, section_name):
+        """Содержимое блока кода первой секции с указанным заголовком"""
+        return self.text(self._by_key.get(section_name.strip().lower()))
+
+    def hunks(self):
+        """
+        Пары (match, patch) в порядке следования в документе.
+
+        Каждая секция match: связывается с ближайшей следующей секцией patch.
+        Непарные секции не отбрасываются: match: без patch дает пару
+        (match, None), patch без match: — (None, patch), а пустой блок
+        кода — None на своем месте, чтобы load_document отверг документ.
+        """
+        match_key = MATCH_SECTION.lower()
+        patch_key = PATCH_SECTION.lower()
+        pairs = []
+        pending = None      # Секция match:, ожидающая patch
+        for section in self.sections:
+            if section.key == match_key:
+                if pending is not None:
+                    pairs.append((self.text(pending), None))
+                pending = section
+            elif section.key == patch_key:
+                pairs.append((self.text(pending), self.text(section)))
+                pending = None
+        if pending is not None:
+            pairs.append((self.text(pending), None))
+        return pairs
+
+
+def parse_document(content):
+    """
+    Построение индекса маркдаун-документа за один проход.
+
+    Для каждого заголовка запоминается первый блок кода (между ```),
+    следующий за ним; содержимое секций затем получается срезом
+    без повторного разбора документа.
+    """
+    sections = []
+    pending = []        # Заголовки, для которых блок кода еще не найден
+    block_start = None  # Начало содержимого открытого блока кода
+    pos = 0
+    length = len(content)
+
+    while pos <= length:
+        eol = content.find('\n', pos)
+        if eol == -1:
+            eol = length
+        stripped_line = content[pos:eol].strip()
+
+        if block_start is not None:
+            if stripped_line.startswith('```'):    # Конец блока кода
+                for idx in pending:
+                    sections[idx] = sections[idx]._replace(start=block_start, end=pos)
+                pending = []
+                block_start = None
+        elif stripped_line.startswith('```'):      # Начало блока кода
+            block_start = min(eol + 1, length)
+        elif stripped_line.startswith('#'):        # Заголовок секции
+            title = stripped_line.lstrip('#').strip()
+            pending.append(len(sections))
+            sections.append(Section(title, title.lower(), pos, None, None))
+        pos = eol + 1
+
+    if block_start is not None:     # Незакрытый блок кода продолжается до конца документа
+        for idx in pending:
+            sections[idx] = sections[idx]._replace(start=block_start, end=length)
+
+    return MarkdownDocument(content, sections)
+
+
+def extract_section(content, section_name):
+    """
+    Извлечение секции кода из маркдаун-контента
+
+    Для получения нескольких секций одного документа выгоднее
+    построить индекс через parse_document и брать секции из него.
+    """
+    return parse_document(content).section(section_name)
+
+
+class InvalidFormatError(ValueError):
+    """Документ не содержит обязательных секций (Source file, match:, patch)"""
+
+
+class NoMatchError(ValueError):
+    """Шаблон match: не найден в исходном коде"""
+
+
+class OverlapError(ValueError):
+    """Правки разных пар match/patch затрагивают один и тот же текст"""
+
+
+class LineIndex:
+    """
+    Индекс начал строк исходного кода.
+
+    Позволяет переводить абсолютные смещения в номера строк и столбцов
+    двоичным поиском (bisect) без разбиения текста на строки.
+    """
+    def __init__(self, text):
+        starts = array('q', [0])
+        starts.extend(m.end() for m in _NEWLINE_RE.finditer(text))
+        self.starts = starts
+        self.length = len(text)
+
+    def line_of(self, offset):
+        """Номер строки (с нуля), содержащей смещение"""
+        return bisect_right(self.starts, offset) - 1
+
+    def position(self, offset):
+        """Пара (строка, столбец) для смещения, обе с нуля"""
+        line = bisect_right(self.starts, offset) - 1
+        return line, offset - self.starts[line]
+
+    def line_start(self, line):
+        """Смещение начала строки"""
+        return self.starts[line]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class SourceIndex:
+    """
+    Индекс исходного кода для применения множества шаблонов к одному тексту.
+
+    Строится один раз на исходный код за один проход регулярным выражением:
+    массив начал строк (LineIndex) и инвертированный индекс слов
+    (идентификаторов и чисел) «слово -> смещения вхождений». Смещения
+    фрагмента шаблона получаются из индекса по самому редкому слову
+    фрагмента без просмотра текста:
+    - слово внутри фрагмента совпадает со словом исходного кода целиком;
+    - последнее слово фрагмента — префикс слова исходного кода;
+    - первое слово фрагмента — суффикс слова исходного кода.
+    Найденные кандидаты проверяются сравнением и запоминаются. Фрагменты
+    без слов просматриваются один раз через str.find; фрагменты, встречающиеся
+    чаще INDEX_MAX_OCCURRENCES раз, не индексируются — их ближайшее
+    вхождение и так находится прямым поиском быстро.
+
+    Индекс строится при первом запросе, поэтому его можно создавать заранее:
+    если все результаты взяты из кэша (ResultCache), текст не индексируется.
+    """
+    def __init__(self, source):
+        self.source = source
+        self._lock = threading.Lock()
+        self._lines = None
+        self._tokens = None
+        self.words = None
+        self.vocabulary = self.reversed_vocabulary = ()
+        self.occurrences = {}   # фрагмент -> array смещений (None — частый фрагмент)
+        self.build_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    @property
+    def built(self):
+        """Построен ли индекс слов (был ли хотя бы один запрос)"""
+        return self.words is not None
+
+    @property
+    def lines(self):
+        """Индекс начал строк (LineIndex), строится при первом обращении"""
+        if self._lines is None:
+            started = perf_counter()
+            self._lines = LineIndex(self.source)
+            self.build_seconds += perf_counter() - started
+        return self._lines
+
+    @property
+    def tokens(self):
+        """Поток лексем (TokenStream) для режима MATCH_TOKENS, строится при первом обращении"""
+        if self._tokens is None:
+            with self._lock:
+                if self._tokens is None:
+                    stream = TokenStream(self.source)
+                    self.build_seconds += stream.build_seconds
+                    self._tokens = stream
+        return self._tokens
+
+    def _build(self):
+        """Построение индекса слов за один проход по тексту"""
+        started = perf_counter()
+        words = {}
+        for m in _WORD_RE.finditer(self.source):
+            found = words.get(m.group())
+            if found is None:
+                found = words[m.group()] = array('q')
+            found.append(m.start())
+        self.vocabulary = sorted(words)                             # для поиска по префиксу
+        self.reversed_vocabulary = sorted(w[::-1] for w in words)   # для поиска по суффиксу
+        self.words = words      # Последним: другие потоки проверяют words перед чтением словарей
+        self.build_seconds += perf_counter() - started
+
+    def _word_range(self, vocabulary, prefix):
+        """Слова словаря, начинающиеся с prefix (не более INDEX_MAX_OCCURRENCES вхождений)"""
+        result = []
+        total = 0
+        for idx in range(bisect_left(vocabulary, prefix), len(vocabulary)):
+            word = vocabulary[idx]
+            if not word.startswith(prefix):
+                break
+            result.append(word)
+            total += len(self.words[word if vocabulary is self.vocabulary else word[::-1]])
+            if total > INDEX_MAX_OCCURRENCES:
+                return None
+        return result
+
+    def _candidates(self, literal):
+        """
+        Кандидаты в начала вхождений фрагмента по индексу слов.
+
+        Возвращает None, если во фрагменте нет слова, пригодного для поиска.
+        """
+        best = None
+        for m in _WORD_RE.finditer(literal):
+            offset, piece = m.start(), m.group()
+            open_left = offset == 0                   # Слово может продолжаться влево
+            open_right = m.end() == len(literal)      # Слово может продолжаться вправо
+            if open_left and open_right:
+                continue    # Фрагмент — часть одного слова, индекс не поможет
+            if not open_left and not open_right:
+                found = self.words.get(piece, ())
+                starts = [pos - offset for pos in found]
+            elif open_right:
+                words = self._word_range(self.vocabulary, piece)
+                if words is None:
+                    continue
+                starts = [pos - offset for word in words for pos in self.words[word]]
+            else:
+                words = self._word_range(self.reversed_vocabulary, piece[::-1])
+                if words is None:
+                    continue
+                starts = [pos + len(word) - len(piece) for word in words for pos in self.words[word[::-1]]]
+            if best is None or len(starts) < len(best):
+                best = starts
+                if not best:
+                    break
+        return best
+
+    def positions(self, literal):
+        """Смещения всех вхождений фрагмента или None, если он слишком частый"""
+        try:
+            return self.occurrences[literal]
+        except KeyError:
+            pass
+        if self.words is None:
+            with self._lock:    # Индекс может использоваться из нескольких потоков (PatchServer)
+                if self.words is None:
+                    self._build()
+        started = perf_counter()
+        source = self.source
+        candidates = self._candidates(literal)
+        if candidates is not None:
+            found = array('q', sorted(pos for pos in candidates if pos >= 0 and source.startswith(literal, pos)))
+        else:   # Во фрагменте нет слов: один просмотр текста
+            found = array('q')
+            pos = source.find(literal)
+            while pos != -1:
+                if len(found) >= INDEX_MAX_OCCURRENCES:
+                    found = None
+                    break
+                found.append(pos)
+                pos = source.find(literal, pos + 1)
+        self.occurrences[literal] = found
+        self.build_seconds += perf_counter() - started
+        return found
+
+    def search(self, regex, literal, pos):
+        """
+        Самое левое совпадение regex не раньше pos.
+
+        Кандидаты — вхождения literal (первого фрагмента группы) из индекса;
+        для частых фрагментов используется обычный regex.search.
+        """
+        started = perf_counter()
+        positions = self.positions(literal)
+        found = None
+        if positions is None:
+            found = regex.search(self.source, pos)
+        else:
+            for idx in range(bisect_left(positions, pos), len(positions)):
+                found = regex.match(self.source, positions[idx])
+                if found is not None:
+                    break
+        self.queries += 1
+        self.query_seconds += perf_counter() - started
+        return found
+
+    def rfind(self, literal, start, end):
+        """Аналог str.rfind по индексу: последнее вхождение в source[start:end]"""
+        started = perf_counter()
+        positions = self.positions(literal)
+        if positions is None:
+            found = self.source.rfind(literal, start, end)
+        else:
+            idx = bisect_right(positions, end - len(literal)) - 1
+            found = positions[idx] if idx >= 0 and positions[idx] >= start else -1
+        self.queries += 1
+        self.query_seconds += perf_counter() - started
+        return found
+
+    def memory_bytes(self):
+        """Приблизительный объем памяти индекса"""
+        total = (sys.getsizeof(self.occurrences) + sys.getsizeof(self.vocabulary)
+                 + sys.getsizeof(self.reversed_vocabulary))
+        if self._lines is not None:
+            total += sys.getsizeof(self._lines.starts)
+        if self._tokens is not None:
+            total += self._tokens.memory_bytes()
+        total += sys.getsizeof(self.words)
+        for word, found in (self.words or {}).items():
+            total += 2 * sys.getsizeof(word) + sys.getsizeof(found)
+        for literal, found in self.occurrences.items():
+            total += sys.getsizeof(literal) + (sys.getsizeof(found) if found is not None else 0)
+        return total
+
+    def stats(self):
+        """Время построения, объем памяти и задержка запросов"""
+        return {
+            "build_ms": round(self.build_seconds * 1000, 3),
+            "memory_bytes": self.memory_bytes(),
+            "lines": len(self._lines) if self._lines is not None else 0,
+            "tokens": len(self._tokens) if self._tokens is not None else 0,
+            "words": len(self.words or ()),
+            "literals": len(self.occurrences),
+            "dense_literals": sum(1 for found in self.occurrences.values() if found is None),
+            "queries": self.queries,
+            "query_ms_total": round(self.query_seconds * 1000, 3),
+            "query_us_avg": round(self.query_seconds * 1e6 / self.queries, 3) if self.queries else 0.0,
+        }
+
+
+class TokenStream:
+    """
+    Исходный код, разобранный на лексемы: слова (\\w+) и отдельные знаки.
+
+    Пробельные символы лексемами не являются. Лексемы хранятся в массивах:
+    номер в словаре лексем (ids) и смещение начала в тексте (starts).
+    Разбор выполняется одним re.split, словарь и смещения строятся
+    встроенными функциями, без цикла на Python по лексемам.
+    Последовательность лексем ищется в байтовом представлении ids
+    (bytes.find) — сравниваются целые числа, а не строки.
+    """
+    def __init__(self, source):
+        started = perf_counter()
+        parts = _TOKEN_RE.split(source)     # [пробелы, лексема, пробелы, ..., хвост]
+        texts = parts[1::2]
+        self.vocabulary = {text: idx for idx, text in enumerate(dict.fromkeys(texts))}
+        self.lengths = array('q', map(len, self.vocabulary))    # Длина лексемы по номеру
+        self.data = array('i', map(self.vocabulary.__getitem__, texts)).tobytes()
+        self.ids = memoryview(self.data).cast('i')
+        # Накопленные длины частей: после пробелов перед лексемой — ее начало
+        starts = array('q', accumulate(map(len, parts)))[::2]
+        starts.pop()    # Конец хвоста — не лексема
+        self.starts = starts
+        self.source_length = len(source)
+        self.build_seconds = perf_counter() - started
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lex(self, text):
+        """Номера лексем текста (-1 — лексемы нет в исходном коде)"""
+        return tuple(self.vocabulary.get(token, -1) for token in _TOKEN_RE.findall(text))
+
+    def offset(self, position):
+        """Смещение в тексте начала лексемы position (или конец текста)"""
+        return self.starts[position] if position < len(self.starts) else self.source_length
+
+    def span(self, first, end):
+        """Смещения (начало, конец) в тексте лексем first..end-1"""
+        return self.starts[first], self.starts[end - 1] + self.lengths[self.ids[end - 1]]
+
+    def find(self, needle, start, end):
+        """Первая позиция последовательности лексем needle (bytes) в start..end или -1"""
+        size = self.ids.itemsize
+        found = self.data.find(needle, start * size, end * size)
+        while found != -1 and found % size:     # Совпадение не на границе лексемы
+            found = self.data.find(needle, found + 1, end * size)
+        return found // size if found != -1 else -1
+
+    def rfind(self, needle, start, end):
+        """Последняя позиция последовательности лексем needle (bytes) в start..end или -1"""
+        size = self.ids.itemsize
+        found = self.data.rfind(needle, start * size, end * size)
+        while found != -1 and found % size:
+            found = self.data.rfind(needle, start * size, found + len(needle) - 1)
+        return found // size if found != -1 else -1
+
+    def memory_bytes(self):
+        """Приблизительный объем памяти потока лексем"""
+        total = sys.getsizeof(self.data) + sys.getsizeof(self.starts) + sys.getsizeof(self.lengths)
+        total += sys.getsizeof(self.vocabulary) + sum(sys.getsizeof(text) for text in self.vocabulary)
+        return total
+
+
+class Edit(namedtuple('Edit', 'start end text')):
+    """Правка исходного кода: замена source[start:end] на text"""
+    __slots__ = ()
+
+
+def apply_edit(source, edit):
+    """Сборка результата одной правки: один срез до и один после"""
+    return ''.join((source[:edit.start], edit.text, source[edit.end:]))
+
+
+def _text(source, start, end):
+    """Срез исходного кода строкой (байтовый исходный код декодируется из UTF-8)"""
+    text = source[start:end]
+    return text if isinstance(text, str) else text.decode('utf-8', 'replace')
+
+
+def _char_before(source, offset):
+    """Символ перед смещением ('' в начале); в байтовом исходном коде — целый символ UTF-8"""
+    if offset <= 0:
+        return ''
+    if isinstance(source, str):
+        return source[offset - 1]
+    start = offset - 1
+    # Байты продолжения (0b10xxxxxx) относятся к символу, начатому раньше
+    while start > 0 and offset - start < 4 and 0x80 <= source[start] <= 0xBF:
+        start -= 1
+    return _text(source, start, offset)
+
+
+def _char_at(source, offset):
+    """Символ по смещению ('' в конце); в байтовом исходном коде — целый символ UTF-8"""
+    if isinstance(source, str):
+        return source[offset:offset + 1]
+    if offset >= len(source):
+        return ''
+    # Длина символа — по первому байту последовательности
+    lead = source[offset]
+    length = 1 if lead < 0xC0 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+    return _text(source, offset, offset + length)
+
+
+def _indent_of(line):
+    """Отступ строки (пробельные символы в начале заменяются пробелами)"""
+    return ' ' * (len(line) - len(line.lstrip()))
+
+
+def _line_at(source, offset):
+    """Границы строки, содержащей смещение: (начало, конец без '\\n')"""
+    newline = '\n' if isinstance(source, str) else b'\n'
+    start = source.rfind(newline, 0, offset) + 1
+    end = source.find(newline, offset)
+    return start, (len(source) if end == -1 else end)
+
+
+class BlockSearcher:
+    """
+    Поиск групп фрагментов шаблона (CompiledPattern.blocks) в исходном коде.
+
+    Вхождение группы — фрагменты, идущие подряд и разделенные только
+    пробельными символами. Прямой поиск выполняется регулярным выражением
+    группы (CompiledPattern.block_res), обратный — через rfind
+    по последнему фрагменту с проверкой остальных фрагментов назад.
+    С индексом SourceIndex кандидаты берутся из него, без просмотра текста.
+    Исходный код может быть и байтовым (bytes, mmap) — тогда шаблон
+    передается в кодировке encode_pattern.
+    """
+    def __init__(self, source, compiled, tracer, index=None):
+        self.source = source
+        self.blocks = [tuple(compiled.literals[i] for i in block) for block in compiled.blocks]
+        self.block_res = compiled.block_res
+        self.tracer = tracer
+        self.index = index
+        self.rfind = index.rfind if index is not None else source.rfind
+        self.searches = 0       # Счетчики для Metrics
+        self.probes = 0
+        self.scanned = 0
+
+    def _miss(self, offset, literal):
+        """Событие трассировки для отброшенного кандидата"""
+        if self.tracer.level >= TRACE_VERBOSE:
+            self.tracer.emit('miss', TRACE_VERBOSE, offset=offset, token=literal)
+
+    def _backward(self, end, literals):
+        """Проверка вхождения группы, заканчивающегося в end: список начал фрагментов или None"""
+        source = self.source
+        starts = []
+        for idx in range(len(literals) - 1, -1, -1):
+            literal = literals[idx]
+            if idx < len(literals) - 1:
+                # Срезы, а не индексы и startswith: так же работают bytes и mmap
+                while end > 0 and source[end - 1:end].isspace():
+                    end -= 1
+            start = end - len(literal)
+            if start < 0 or source[start:end] != literal:
+                return None
+            starts.append(start)
+            end = start
+        starts.reverse()
+        return starts
+
+    def search(self, k, pos):
+        """Самое левое вхождение группы k, начинающееся не раньше pos"""
+        self.searches += 1
+        if self.index is not None:
+            found = self.index.search(self.block_res[k], self.blocks[k][0], pos)
+        else:
+            found = self.block_res[k].search(self.source, pos)
+            self.scanned += (found.end() if found is not None else len(self.source)) - pos
+        if found is None:
+            self._miss(pos, self.blocks[k][0])
+            return None
+        return [found.start(i) for i in range(1, len(self.blocks[k]) + 1)]
+
+    def rsearch(self, k, limit, lower=0):
+        """
+        Самое правое вхождение группы k, заканчивающееся не позже limit.
+
+        lower — нижняя граница поиска (известно, что вхождение есть правее).
+        Если проверка кандидатов, найденных rfind, много раз подряд
+        неудачна, оставшийся участок перебирается регулярным выражением
+        группы — так число шагов на Python определяется числом настоящих
+        вхождений, а не ложных кандидатов.
+        """
+        literals = self.blocks[k]
+        last = literals[-1]
+        rfind = self.rfind
+        found = rfind(last, lower, limit)
+        for _ in range(RSEARCH_PROBES):
+            self.probes += 1
+            if found == -1:
+                return None
+            starts = self._backward(found + len(last), literals)
+            if starts is not None:
+                return starts
+            self._miss(found, last)
+            found = rfind(last, lower, found + len(last) - 1)
+        if found == -1:
+            return None
+
+        source = self.source
+        regex = self.block_res[k]
+        best = None
+        self.scanned += found + len(last) - lower
+        current = regex.search(source, lower, found + len(last))
+        while current is not None:
+            best = current
+            current = regex.search(source, current.start() + 1, found + len(last))
+        if best is None:
+            return None
+        return [best.start(i) for i in range(1, len(literals) + 1)]
+
+
+class TokenSearcher:
+    """
+    Поиск групп фрагментов шаблона в потоке лексем (TokenStream).
+
+    Интерфейс тот же, что у BlockSearcher, но позиции — номера лексем.
+    Фрагменты шаблона разбираются на лексемы тем же правилом, что и
+    исходный код, а группа ищется как одна последовательность лексем
+    всех ее фрагментов, поэтому пробелы и переводы строк не учитываются
+    ни в шаблоне, ни в исходном коде. Фрагмент совпадает только с целыми
+    лексемами. pattern — шаблон в форме лексем для match_spans.
+    """
+    def __init__(self, stream, compiled, tracer):
+        self.stream = stream
+        self.compiled = compiled
+        self.tracer = tracer
+        literals = tuple(stream.lex(literal) for literal in compiled.literals)
+        self.pattern = compiled._replace(literals=literals)
+        self.needles = [array('i', [token for idx in block for token in literals[idx]]).tobytes()
+                        for block in compiled.blocks]
+        self.searches = 0       # Счетчики для Metrics
+        self.probes = 0
+        self.scanned = 0
+
+    def _starts(self, k, first):
+        """Номера первых лексем фрагментов группы k, начинающейся с лексемы first"""
+        starts = []
+        for idx in self.compiled.blocks[k]:
+            starts.append(first)
+            first += len(self.pattern.literals[idx])
+        return starts
+
+    def search(self, k, pos):
+        """Самое левое вхождение группы k, начинающееся не раньше лексемы pos"""
+        self.searches += 1
+        stream = self.stream
+        found = stream.find(self.needles[k], pos, len(stream))
+        self.scanned += (found if found != -1 else len(stream)) - pos
+        if found == -1:
+            if self.tracer.level >= TRACE_VERBOSE:
+                literal = self.compiled.literals[self.compiled.blocks[k][0]]
+                self.tracer.emit('miss', TRACE_VERBOSE, offset=stream.offset(pos), token=literal)
+            return None
+        return self._starts(k, found)
+
+    def rsearch(self, k, limit, lower=0):
+        """Самое правое вхождение группы k, заканчивающееся не позже лексемы limit"""
+        self.probes += 1
+        found = self.stream.rfind(self.needles[k], lower, limit)
+        return None if found == -1 else self._starts(k, found)
+
+
+def match_spans(searcher, compiled):
+    """
+    Поиск первого полного вхождения шаблона: (начало, конец) каждого фрагмента.
+
+    Между группами фрагментов стоит wildcard, поэтому жадный поиск
+    каждой группы от конца предыдущей находит вхождение с самым ранним
+    концом E, если оно вообще существует. Обратный проход от E выбирает
+    самое позднее начало S (самое короткое вхождение, без «приманок»
+    перед ним), и прямой проход от S восстанавливает позиции фрагментов.
+    Результаты прямого поиска запоминаются: (k, pos) -> вхождение
+    переиспользуется, пока pos не выходит за начало найденного вхождения.
+    Каждый проход просматривает исходный код не более одного раза.
+    Возвращает None, если шаблон не найден.
+    """
+    literals = compiled.literals
+    count = len(compiled.blocks)
+    memo = {}
+
+    def search(k, pos):
+        cached = memo.get(k)
+        if cached is not None and cached[0] <= pos <= cached[1][0]:
+            return cached[1]
+        starts = searcher.search(k, pos)
+        if starts is not None:
+            memo[k] = (pos, starts)
+        return starts
+
+    def block_end(k, starts):
+        return starts[-1] + len(literals[compiled.blocks[k][-1]])
+
+    # Прямой проход: самый ранний конец полного вхождения
+    pos = 0
+    earliest = []   # Самые ранние начала групп — нижние границы для обратного прохода
+    for k in range(count):
+        starts = search(k, pos)
+        if starts is None:
+            return None
+        earliest.append(starts[0])
+        pos = block_end(k, starts)
+
+    # Обратный проход: самое позднее начало вхождения, заканчивающегося в pos
+    for k in range(count - 1, -1, -1):
+        pos = searcher.rsearch(k, pos, earliest[k])[0]
+
+    # Повторный прямой проход от найденного начала
+    spans = []
+    for k in range(count):
+        starts = search(k, pos)
+        for idx, start in zip(compiled.blocks[k], starts):
+            spans.append((start, start + len(literals[idx])))
+        pos = block_end(k, starts)
+    return spans
+
+
+def find_edit(source, match_pattern, patch, tracer=None, index=None, metrics=None, mode=MATCH_TEXT):
+    """
+    Поиск места применения патча и построение правки Edit.
+
+    Шаблон сопоставляется с цельной строкой исходного кода (match_spans):
+    находится первое полное вхождение всех текстовых фрагментов, включая
+    фрагменты после маркера. Wildcard (...) и маркеры (>>>, <<<) пропускают
+    произвольный текст, а фрагменты без них между собой должны идти подряд
+    (допускаются только пробельные символы). Время поиска линейно по размеру исходного
+    кода (с множителем длины шаблона), возвратов с экспоненциальным
+    перебором нет. Если шаблон не найден, выбрасывается NoMatchError.
+    index — необязательный SourceIndex, построенный для того же source;
+    metrics получает время фаз tokenize и match и счетчики поиска.
+    source может быть байтовым (bytes, mmap с текстом в UTF-8): тогда
+    смещения правки — смещения в байтах, а текст правки остается строкой.
+    В режиме mode=MATCH_TOKENS шаблон сопоставляется с потоком лексем
+    (TokenSearcher, поток берется из index.tokens): пробелы и переводы
+    строк не учитываются, фрагменты совпадают только с целыми лексемами.
+    """
+    if mode not in MATCH_MODES:
+        raise ValueError(f"Unknown match mode '{mode}'")
+    if tracer is None:
+        tracer = _tracer
+    if metrics is None:
+        metrics = _metrics
+    with metrics.phase('tokenize'):
+        compiled = match_pattern if isinstance(match_pattern, CompiledPattern) else compile_pattern(match_pattern)
+
+    # compile_pattern кэшируется и не трассирует: токены выводятся при каждом поиске
+    if tracer.level >= TRACE_DEBUG:
+        for kind, value in compiled.tokens:
+            tracer.emit('tokenize', TRACE_DEBUG, type=kind, value=_SPECIAL_TEXT.get(kind, value))
+
+    if compiled.marker_index is None:
+        raise NoMatchError("Marker (>>>) not found")
+
+    if tracer.level >= TRACE_DEBUG:
+        tracer.emit('tokens', TRACE_DEBUG, tokens=list(compiled.literals), blocks=[list(b) for b in compiled.blocks])
+
+    if index is not None and index.source is not source and index.source != source:
+        raise ValueError("SourceIndex was built for a different source")
+
+    text_source = isinstance(source, str)
+    if mode == MATCH_TOKENS:
+        if not text_source:
+            raise ValueError("Token matching requires a text source")
+        with metrics.phase('lex'):
+            stream = index.tokens if index is not None else TokenStream(source)
+    with metrics.phase('match'):
+        if mode == MATCH_TOKENS:
+            searcher = TokenSearcher(stream, compiled, tracer)
+            spans = match_spans(searcher, searcher.pattern)
+            if spans is not None:   # Номера лексем -> смещения в тексте
+                spans = [stream.span(first, end) for first, end in spans]
+        else:
+            searched = compiled if text_source else encode_pattern(compiled)
+            searcher = BlockSearcher(source, searched, tracer, index)
+            spans = match_spans(searcher, searched)
+    if metrics.enabled:
+        metrics.count('searches', searcher.searches)
+        metrics.count('probes', searcher.probes)
+        metrics.count('scanned_tokens' if mode == MATCH_TOKENS else 'scanned_chars', searcher.scanned)
+    if spans is None:
+        raise NoMatchError("Pattern not found")
+
+    lines = None
+    if tracer.level >= TRACE_DEBUG:     # Номера строк нужны только для трассировки
+        if text_source:
+            lines = index.lines if index is not None else LineIndex(source)
+        for literal, (start, _) in zip(compiled.literals, spans):
+            if lines is None:   # Байтовый исходный код не индексируется: смещение вместо строки
+                tracer.emit('match', TRACE_DEBUG, offset=start, token=literal)
+                continue
+            line, column = lines.position(start)
+            tracer.emit('match', TRACE_DEBUG, line=line + 1, column=column, token=literal)
+
+    marker_at = compiled.marker_at
+    insert_pos = spans[marker_at - 1][1] if marker_at else 0   # Конец последнего фрагмента перед >>>
+
+    if compiled.replace_span is not None:
+        # Вариант 1: замена текста между >>> и <<<
+        first, last = compiled.replace_span
+        edit = Edit(spans[first][0], spans[last][1], patch)
+        kind = 'replace'
+    elif compiled.anchor is not None:
+        # Вариант 2: вставка перед первым фрагментом после маркера
+        found = spans[marker_at][0]
+        # Добавляем пробел, если патч "сливается" с окружающим текстом
+        prev_char = _char_before(source, found)
+        next_char = _char_at(source, found)
+        space_before = prev_char.isalnum() and patch[:1].isalnum()
+        space_after = patch[-1:].isalnum() and next_char.isalnum()
+        edit = Edit(found, found, (' ' if space_before else '') + patch + (' ' if space_after else ''))
+        kind = 'insert'
+    elif not marker_at:
+        # До маркера нет фрагментов — вставка отдельной строкой в начало
+        edit = Edit(0, 0, patch.strip() + '\n')
+        kind = 'insert'
+    else:
+        # Вариант 3: вставка на новой строке после строки последнего совпадения
+        line_start, line_end = _line_at(source, insert_pos)
+        current_line = _text(source, line_start, line_end)
+        indent = _indent_of(current_line)
+
+        # Если строка заканчивается на '{', используем отступ следующей строки
+        if current_line.rstrip().endswith('{') and line_end < len(source):
+            next_start, next_end = _line_at(source, line_end + 1)
+            indent = _indent_of(_text(source, next_start, next_end))
+        edit = Edit(line_end, line_end, '\n' + indent + patch.strip())
+        kind = 'insert'
+
+    if tracer.level >= TRACE_INFO:
+        text = _text(source, edit.start, edit.end) or patch
+        if text_source:
+            lines = lines or (index.lines if index is not None else LineIndex(source))
+            line, column = lines.position(edit.start)
+            tracer.emit(kind, TRACE_INFO, line=line + 1, column=column, text=text)
+        else:
+            tracer.emit(kind, TRACE_INFO, offset=edit.start, text=text)
+    return edit
+
+
+def apply_patch(source, match_pattern, patch, strict=False, tracer=None, index=None, cache=None, metrics=None,
+                mode=MATCH_TEXT):
+    """
+    Применяет патч к исходному коду на основе шаблона.
+
+    Логика работы:
+    1. Токенизация шаблона (compile_pattern, с кэшированием): текст, wildcard (...), маркеры (>>> и <<<).
+    2. Поиск соответствий токенов в исходном коде (find_edit).
+    3. Вставка или замена текста согласно патчу одним срезом (apply_edit).
+
+    Если шаблон не найден, возвращается исходный код без изменений,
+    а при strict=True выбрасывается NoMatchError. Ход сопоставления
+    передается в tracer (по умолчанию — глобальный трассировщик).
+    Для многократного применения шаблонов к одному исходному коду
+    можно передать заранее построенный SourceIndex. Результат поиска
+    кэшируется в cache (по умолчанию — глобальный ResultCache, False — без кэша).
+    Время фаз и счетчики записываются в metrics (см. Metrics).
+    mode — режим сопоставления (MATCH_TEXT или MATCH_TOKENS, см. find_edit).
+    """
+    if tracer is None:
+        tracer = _tracer
+    if cache is None:
+        cache = _result_cache
+    if metrics is None:
+        metrics = _metrics
+    # Шаблон может быть передан уже скомпилированным
+    with metrics.phase('tokenize'):
+        compiled = match_pattern if isinstance(match_pattern, CompiledPattern) else compile_pattern(match_pattern)
+    if tracer.level >= TRACE_INFO:
+        tracer.emit('apply', TRACE_INFO, pattern=compiled.text, patch=patch, source_length=len(source))
+
+    with metrics.phase('hash'):
+        digest = cache.source_digest(source) if cache else None
+    metrics.count('hunks')
+    edit = _lookup_edit(source, digest, compiled, patch, tracer, index, cache, metrics, mode)
+    if not isinstance(edit, Edit):
+        if tracer.level >= TRACE_INFO:
+            tracer.emit('fail', TRACE_INFO, reason=edit)
+        if strict:
+            raise NoMatchError(edit)
+        return source   # Шаблон не найден — исходный код без изменений
+    metrics.count('edits')
+    with metrics.phase('assemble'):
+        return apply_edit(source, edit)
+
+
+class MemoryCache:
+    """LRU-кэш результатов в памяти процесса"""
+    def __init__(self, capacity=RESULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class DiskCache:
+    """
+    Дисковый уровень кэша результатов в базе sqlite.
+
+    Базу могут использовать несколько процессов пула одновременно
+    (журнал WAL). При превышении max_bytes удаляются записи, к которым
+    дольше всего не обращались, до 90% от предела.
+    """
+    def __init__(self, path, max_bytes=RESULT_CACHE_DISK_BYTES):
+        import sqlite3     # Импортируется только при включенном дисковом кэше
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "key TEXT PRIMARY KEY, start INTEGER, end INTEGER, text TEXT, "
+                        "size INTEGER, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.size = self._total_size()
+
+    def _total_size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def get(self, key):
+        row = self.db.execute("SELECT start, end, text FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time(), key))
+        start, end, text = row
+        return text if start is None else Edit(start, end, text)
+
+    def put(self, key, value):
+        if isinstance(value, Edit):
+            start, end, text = value
+        else:
+            start = end = None
+            text = value
+        size = len(key) + len(text.encode('utf-8', 'surrogatepass')) + 32
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, start, end, text, size, time()))
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Удаление давно не использованных записей до 90% от max_bytes"""
+        self.size = self._total_size()     # Записи могли добавить другие процессы
+        target = self.max_bytes * 9 // 10
+        if self.size <= target:
+            return
+        rows = self.db.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        stale = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            stale.append((key,))
+            self.size -= size
+        self.db.executemany("DELETE FROM results WHERE key = ?", stale)
+
+    def clear(self):
+        self.db.execute("DELETE FROM results")
+        self.size = 0
+
+    def close(self):
+        self.db.close()
+
+
+class ResultCache:
+    """
+    Кэш результатов поиска места применения патча (find_edit).
+
+    Ключ — хэш SHA-256 от версии движка (ENGINE_VERSION), исходного кода,
+    шаблона и патча, значение — правка Edit или причина несовпадения.
+    Первый уровень — LRU в памяти, второй (необязательный) — DiskCache,
+    общий для всех процессов и запусков. Повторное применение документа
+    находит неизмененные пары без поиска; пересчитываются только
+    измененные. Счетчики попаданий возвращает stats().
+    """
+    def __init__(self, capacity=RESULT_CACHE_SIZE, disk=None):
+        self.memory = MemoryCache(capacity)
+        self.disk = disk
+        self.lock = threading.Lock()    # Кэш используется из фоновых потоков GUI
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def source_digest(source):
+        """Хэш исходного кода (вычисляется один раз на документ)"""
+        return hashlib.sha256(source.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    @staticmethod
+    def key(source_digest, match_pattern, patch, mode=MATCH_TEXT):
+        """Ключ результата для пары (шаблон, патч) и исходного кода с хэшем source_digest"""
+        text = match_pattern.text if isinstance(match_pattern, CompiledPattern) else match_pattern
+        parts = [ENGINE_VERSION, source_digest, text, patch]
+        if mode != MATCH_TEXT:      # Ключи текстового режима не меняются
+            parts.append(mode)
+        payload = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def get(self, key):
+        """Edit, причина несовпадения (str) или None, если результата нет"""
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory_hits += 1
+                return value
+            if self.disk is not None:
+                value = self.disk.get(key)
+                if value is not None:
+                    self.memory.put(key, value)
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.memory.put(key, value)
+            if self.disk is not None:
+                self.disk.put(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.disk is not None:
+                self.disk.clear()
+
+    def stats(self):
+        """Число попаданий по уровням, промахов и доля попаданий"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_result_cache = ResultCache()     # Глобальный кэш результатов (только в памяти)
+
+
+def get_result_cache():
+    """Текущий глобальный кэш результатов"""
+    return _result_cache
+
+
+def set_result_cache(cache):
+    """Установка глобального кэша результатов (None — кэш в памяти по умолчанию, False — без кэша)"""
+    global _result_cache
+    _result_cache = cache if cache is not None else ResultCache()
+
+
+def _lookup_edit(source, digest, match_pattern, patch, tracer, index, cache, metrics, mode):
+    """Правка из кэша или find_edit; при несовпадении — его причина (str)"""
+    if cache:
+        with metrics.phase('cache'):
+            key = cache.key(digest, match_pattern, patch, mode)
+            result = cache.get(key)
+        if result is not None:
+            metrics.count('cache_hits')
+            if tracer.level >= TRACE_DEBUG:
+                tracer.emit('cached', TRACE_DEBUG, key=key)
+            return result
+    try:
+        result = find_edit(source, match_pattern, patch, tracer, index, metrics, mode)
+    except NoMatchError as e:
+        result = str(e)
+    if cache:
+        with metrics.phase('cache'):
+            cache.put(key, result)
+    return result
+
+
+def plan_edits(source, hunks, strict=False, tracer=None, index=None, cache=None, metrics=None, mode=MATCH_TEXT):
+    """
+    Поиск мест применения всех пар (шаблон, патч) в исходном коде.
+
+    Все шаблоны сопоставляются с исходным текстом (а не с результатом
+    предыдущих патчей). Возвращает правки, упорядоченные по смещению.
+    Ненайденные шаблоны пропускаются, а при strict=True приводят
+    к NoMatchError; пересекающиеся правки — к OverlapError.
+    Результаты поиска берутся из кэша cache (по умолчанию — глобальный
+    ResultCache) и сохраняются в него; False отключает кэш.
+    В режиме MATCH_TOKENS исходный код разбирается на лексемы один раз
+    для всех пар (SourceIndex.tokens, индекс создается при необходимости).
+    """
+    if tracer is None:
+        tracer = _tracer
+    if cache is None:
+        cache = _result_cache
+    if metrics is None:
+        metrics = _metrics
+    if mode == MATCH_TOKENS and index is None and isinstance(source, str):
+        index = SourceIndex(source)
+    with metrics.phase('hash'):
+        digest = cache.source_digest(source) if cache else None
+    metrics.count('hunks', len(hunks))
+    planned = []    # (правка, номер пары)
+    for idx, (match_pattern, patch) in enumerate(hunks):
+        if tracer.level >= TRACE_INFO:
+            tracer.emit('apply', TRACE_INFO, hunk=idx + 1, patch=patch, source_length=len(source))
+        result = _lookup_edit(source, digest, match_pattern, patch, tracer, index, cache, metrics, mode)
+        if isinstance(result, Edit):
+            planned.append((result, idx))
+            continue
+        if tracer.level >= TRACE_INFO:
+            tracer.emit('fail', TRACE_INFO, hunk=idx + 1, reason=result)
+        if strict:
+            raise NoMatchError(f"Hunk {idx + 1}: {result}")
+    return _ordered_edits(planned)
+
+
+def _ordered_edits(planned):
+    """Правки из пар (правка, номер пары), упорядоченные по смещению; пересечение — OverlapError"""
+    # Вставки в одной точке сохраняют порядок пар в документе
+    planned.sort(key=lambda item: (item[0].start, item[0].end, item[1]))
+    for (prev, prev_idx), (edit, idx) in zip(planned, planned[1:]):
+        if edit.start < prev.end:
+            raise OverlapError(f"Hunks {prev_idx + 1} and {idx + 1} modify overlapping text")
+    return [edit for edit, _ in planned]
+
+
+def apply_edits(source, edits):
+    """
+    Сборка результата из упорядоченных непересекающихся правок.
+
+    Результат собирается как таблица фрагментов: неизмененные срезы
+    исходного кода чередуются с текстами правок и склеиваются один раз.
+    """
+    pieces = []
+    pos = 0
+    for edit in edits:
+        pieces.append(source[pos:edit.start])
+        pieces.append(edit.text)
+        pos = edit.end
+    pieces.append(source[pos:])
+    return ''.join(pieces)
+
+
+def write_edits(source, edits, out):
+    """
+    Потоковая запись результата правок в двоичный файл out.
+
+    Результат не собирается в памяти: неизмененные участки исходного кода
+    (bytes, mmap) записываются срезами memoryview без копирования порциями
+    по STREAM_CHUNK_BYTES (одна запись огромного участка mmap заметно
+    медленнее), тексты правок кодируются в UTF-8 по одному.
+    """
+    def copy(view, start, end):
+        for pos in range(start, end, STREAM_CHUNK_BYTES):
+            out.write(view[pos:min(pos + STREAM_CHUNK_BYTES, end)])
+
+    pos = 0
+    with memoryview(source) as view:
+        for edit in edits:
+            copy(view, pos, edit.start)
+            out.write(edit.text.encode('utf-8'))
+            pos = edit.end
+        copy(view, pos, len(view))
+
+
+def _replace_file(path, source, edits):
+    """Атомарная замена файла path результатом правок (временный файл рядом и os.replace)"""
+    import tempfile
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write_edits(source, edits, out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+
+def patch_file(path, hunks, output_path=None, strict=False, tracer=None, metrics=None, session=None):
+    """
+    Применение пар (шаблон, патч) к внешнему файлу без загрузки его в память.
+
+    Файл отображается в память (mmap) и просматривается как байты UTF-8
+    (см. find_edit), результат потоково записывается в output_path
+    (write_edits). Если output_path не задан, результат записывается во
+    временный файл рядом с исходным, который затем атомарно заменяет его.
+    Кроме отображения файла, в памяти находятся только правки. Кэш
+    результатов не используется: хэш потребовал бы лишнего чтения файла.
+    С session (PatchSession, тогда strict берется из нее) результаты
+    неизмененных пар переиспользуются, пока не изменились время изменения
+    и размер файла. Возвращает правки (смещения в байтах).
+    """
+    import mmap
+
+    if metrics is None:
+        metrics = _metrics
+    temp_path = None
+    with open(path, 'rb') as f:
+        # Пустой файл отобразить нельзя, его содержимое — b''
+        stat = os.fstat(f.fileno())
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        try:
+            if session is not None:
+                source_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+                edits = session.plan(mapped, hunks, tracer, metrics, source_key)
+            else:
+                edits = plan_edits(mapped, hunks, strict, tracer, cache=False, metrics=metrics)
+            metrics.count('edits', len(edits))
+            with metrics.phase('write'):
+                if output_path is not None:
+                    with open(output_path, 'wb') as out:
+                        write_edits(mapped, edits, out)
+                elif edits:
+                    temp_path = _replace_file(path, mapped, edits)
+        finally:
+            if not isinstance(mapped, bytes):
+                mapped.close()
+    if temp_path is not None:   # Замена после закрытия отображения (иначе не работает в Windows)
+        os.replace(temp_path, path)
+    return edits
+
+
+def _split_lines(text):
+    """Строки текста с '\\n' на конце (в отличие от splitlines, разбиение только по '\\n')"""
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _diff_range(start, count):
+    """Диапазон строк для заголовка блока unified diff (start — с нуля)"""
+    if count == 1:
+        return str(start + 1)
+    return f"{start + 1 if count else start},{count}"
+
+
+def iter_unified_diff(source, edits, name="source", context=DIFF_CONTEXT, lines=None):
+    """
+    Unified diff упорядоченных непересекающихся правок (по строкам вывода).
+
+    Diff строится по смещениям правок, без сравнения исходного кода
+    с результатом: затронутые строки находятся по LineIndex (lines —
+    готовый индекс, например SourceIndex.lines), одинаковые строки в начале
+    и конце измененного фрагмента становятся контекстом. Объем вывода
+    определяется числом и размером правок, а не размером исходного кода.
+    """
+    if lines is None:
+        lines = LineIndex(source)
+    starts = lines.starts
+    total = len(starts) - (1 if not source or source.endswith('\n') else 0)   # Число строк
+
+    def line_end(line):
+        return starts[line + 1] if line + 1 < len(starts) else len(source)
+
+    # Изменения: (первая строка, удаленные строки, добавленные строки)
+    changes = []
+
+    def add_change(first, last, group):
+        begin, end = starts[first], line_end(last)
+        pieces = []
+        pos = begin
+        for edit in group:
+            pieces += (source[pos:edit.start], edit.text)
+            pos = edit.end
+        pieces.append(source[pos:end])
+        old, new = _split_lines(source[begin:end]), _split_lines(''.join(pieces))
+        common = min(len(old), len(new))
+        head = 0
+        while head < common and old[head] == new[head]:
+            head += 1
+        tail = 0
+        while tail < common - head and old[-1 - tail] == new[-1 - tail]:
+            tail += 1
+        if len(old) - tail > head or len(new) - tail > head:
+            changes.append((first + head, old[head:len(old) - tail], new[head:len(new) - tail]))
+
+    # Правки, затрагивающие одни и те же строки, объединяются в одно изменение
+    group, first, last = [], 0, -1
+    for edit in edits:
+        edit_first = lines.line_of(edit.start)
+        edit_last = lines.line_of(edit.end)    # Строка, в которой продолжается текст после правки
+        if group and edit_first > last:
+            add_change(first, last, group)
+            group = []
+        if not group:
+            first = edit_first
+        group.append(edit)
+        last = max(last, edit_last) if len(group) > 1 else edit_last
+    if group:
+        add_change(first, last, group)
+    if not changes:
+        return
+
+    yield f"--- a/{name}\n"
+    yield f"+++ b/{name}\n"
+    offset = 0      # Разница числа строк результата и исходного кода перед блоком
+    i = 0
+    while i < len(changes):
+        # Изменения, между которыми не больше 2 * context строк, выводятся одним блоком
+        j = i + 1
+        while j < len(changes) and changes[j][0] - changes[j - 1][0] - len(changes[j - 1][1]) <= 2 * context:
+            j += 1
+        low = max(0, changes[i][0] - context)
+        high = min(total, changes[j - 1][0] + len(changes[j - 1][1]) + context)
+        delta = sum(len(new) - len(old) for _, old, new in changes[i:j])
+        yield f"@@ -{_diff_range(low, high - low)} +{_diff_range(low + offset, high - low + delta)} @@\n"
+
+        body = []
+        pos = low
+        for start, old, new in changes[i:j]:
+            body.extend(' ' + source[starts[k]:line_end(k)] for k in range(pos, start))
+            body.extend('-' + line for line in old)
+            body.extend('+' + line for line in new)
+            pos = start + len(old)
+        body.extend(' ' + source[starts[k]:line_end(k)] for k in range(pos, high))
+        for line in body:
+            yield line if line.endswith('\n') else line + '\n\\ No newline at end of file\n'
+        offset += delta
+        i = j
+
+
+def unified_diff(source, edits, name="source", context=DIFF_CONTEXT, lines=None):
+    """Unified diff правок одной строкой (см. iter_unified_diff); пустая строка, если изменений нет"""
+    return ''.join(iter_unified_diff(source, edits, name, context, lines))
+
+
+def apply_hunks(source, hunks, strict=False, tracer=None, index=None, cache=None, metrics=None, mode=MATCH_TEXT):
+    """
+    Применение нескольких пар (шаблон, патч) к исходному коду за один проход.
+
+    Стоимость определяется размером исходного кода и числом правок:
+    промежуточные версии текста не строятся (см. plan_edits).
+    Начиная с INDEX_MIN_HUNKS пар для поиска строится SourceIndex.
+    """
+    if index is None and len(hunks) >= INDEX_MIN_HUNKS:
+        index = SourceIndex(source)
+    if metrics is None:
+        metrics = _metrics
+    edits = plan_edits(source, hunks, strict, tracer, index, cache, metrics, mode)
+    metrics.count('edits', len(edits))
+    with metrics.phase('assemble'):
+        return apply_edits(source, edits)
+
+
+class PatchSession:
+    """
+    Повторное применение редактируемого документа (режим наблюдения).
+
+    Результаты поиска хранятся по содержимому пары (match, patch): при
+    очередном применении заново ищутся только пары, которых не было
+    в предыдущем, остальные правки берутся из него. Если изменился
+    исходный код (его ключ source_key — по умолчанию сам текст), результаты
+    сбрасываются, а хэш для ResultCache и SourceIndex вычисляются заново
+    один раз на версию текста. Номера пересчитанных пар (с 1) — в changed.
+    """
+    def __init__(self, strict=False, cache=None, mode=MATCH_TEXT):
+        self.strict = strict
+        self.cache = cache
+        self.mode = mode
+        self.source_key = None
+        self.digest = None
+        self.index = None
+        self.results = {}   # (шаблон, патч) -> Edit или причина несовпадения (str)
+        self.changed = []
+
+    def plan(self, source, hunks, tracer=None, metrics=None, source_key=None):
+        """
+        Правки для пар документа (как plan_edits) с переиспользованием
+        результатов неизмененных пар
+        """
+        if tracer is None:
+            tracer = _tracer
+        if metrics is None:
+            metrics = _metrics
+        text_source = isinstance(source, str)
+        # Байтовый исходный код (mmap) не хэшируется, см. patch_file
+        cache = (_result_cache if self.cache is None else self.cache) if text_source else False
+        if source_key is None:
+            source_key = source
+        if source_key != self.source_key:
+            self.source_key = source_key
+            self.results = {}
+            self.index = None
+            with metrics.phase('hash'):
+                self.digest = cache.source_digest(source) if cache else None
+        if self.index is None and text_source and (len(hunks) >= INDEX_MIN_HUNKS or self.mode == MATCH_TOKENS):
+            self.index = SourceIndex(source)
+        metrics.count('hunks', len(hunks))
+
+        results = {}
+        planned = []    # (правка, номер пары)
+        changed = []
+        failure = None
+        for idx, (match_pattern, patch) in enumerate(hunks):
+            key = (match_pattern.text if isinstance(match_pattern, CompiledPattern) else match_pattern, patch)
+            result = results.get(key) or self.results.get(key)
+            if result is None:
+                if tracer.level >= TRACE_INFO:
+                    tracer.emit('apply', TRACE_INFO, hunk=idx + 1, patch=patch, source_length=len(source))
+                result = _lookup_edit(source, self.digest, match_pattern, patch, tracer, self.index, cache,
+                                      metrics, self.mode)
+                changed.append(idx + 1)
+                if not isinstance(result, Edit) and tracer.level >= TRACE_INFO:
+                    tracer.emit('fail', TRACE_INFO, hunk=idx + 1, reason=result)
+            results[key] = result
+            if isinstance(result, Edit):
+                planned.append((result, idx))
+            elif failure is None:
+                failure = f"Hunk {idx + 1}: {result}"
+        # Результаты сохраняются и при ошибке, чтобы следующее применение не искало их заново
+        self.results = results
+        self.changed = changed
+        if self.strict and failure is not None:
+            raise NoMatchError(failure)
+        return _ordered_edits(planned)
+
+    def apply(self, source, hunks, tracer=None, metrics=None):
+        """Результат применения пар (как apply_hunks)"""
+        if metrics is None:
+            metrics = _metrics
+        edits = self.plan(source, hunks, tracer, metrics)
+        metrics.count('edits', len(edits))
+        with metrics.phase('assemble'):
+            return apply_edits(source, edits)
+
+    def diff(self, source, hunks, tracer=None, metrics=None, name="source", context=DIFF_CONTEXT):
+        """Unified diff изменений (как diff_hunks)"""
+        if metrics is None:
+            metrics = _metrics
+        edits = self.plan(source, hunks, tracer, metrics)
+        metrics.count('edits', len(edits))
+        with metrics.phase('diff'):
+            return unified_diff(source, edits, name, context, self.index.lines if self.index is not None else None)
+
+
+def load_external_document(content, base_dir=''):
+    """
+    Разбор документа, ссылающегося на внешний исходный файл: (путь, пары).
+
+    Вместо блока кода Source file документ содержит секцию Source path
+    с путем к файлу; относительный путь отсчитывается от base_dir
+    (обычно каталога документа). Если секции Source path нет или документ
+    содержит Source file, путь — None.
+    """
+    document = parse_document(content)
+    path = document.section(SOURCE_PATH_SECTION)
+    hunks = document.hunks()
+    if path is None or document.section(SOURCE_SECTION) is not None:
+        return None, hunks
+    if not hunks or not all(m and p for m, p in hunks):
+        raise InvalidFormatError("Invalid file format")
+    return os.path.join(base_dir, os.path.expanduser(path)), hunks
+
+
+def diff_hunks(source, hunks, strict=False, tracer=None, index=None, cache=None, metrics=None,
+               name="source", context=DIFF_CONTEXT, mode=MATCH_TEXT):
+    """
+    Поиск мест применения пар (как в apply_hunks) и вывод изменений
+    в виде unified diff вместо полного текста результата.
+    """
+    if index is None and len(hunks) >= INDEX_MIN_HUNKS:
+        index = SourceIndex(source)
+    if metrics is None:
+        metrics = _metrics
+    edits = plan_edits(source, hunks, strict, tracer, index, cache, metrics, mode)
+    metrics.count('edits', len(edits))
+    with metrics.phase('diff'):
+        return unified_diff(source, edits, name, context, index.lines if index is not None else None)
+
+
+def load_document(content):
+    """
+    Разбор документа: исходный код и список пар (match, patch).
+
+    Если обязательных секций нет, выбрасывается InvalidFormatError.
+    """
+    document = parse_document(content)     # Один проход по документу
+    source = document.section(SOURCE_SECTION)
+    hunks = document.hunks()
+
+    if not source or not hunks or not all(m and p for m, p in hunks):
+        raise InvalidFormatError("Invalid file format")
+    return source, hunks
+
+
+def apply_document(content, strict=False, tracer=None, metrics=None, mode=MATCH_TEXT):
+    """
+    Разбор документа и применение всех пар match/patch (см. apply_hunks).
+
+    Возвращает исходный код, список пар (match, patch) и результат.
+    При strict=True ненайденный шаблон приводит к NoMatchError.
+    """
+    if metrics is None:
+        metrics = _metrics
+    with metrics.phase('parse'):
+        source, hunks = load_document(content)
+    modified = apply_hunks(source, hunks, strict, tracer, metrics=metrics, mode=mode)
+    return source, hunks, modified
+
+
+def diff_document(content, strict=False, tracer=None, metrics=None, name="source", context=DIFF_CONTEXT,
+                  mode=MATCH_TEXT):
+    """
+    Разбор документа и вывод изменений в виде unified diff (см. diff_hunks).
+
+    Возвращает исходный код, список пар (match, patch) и diff.
+    """
+    if metrics is None:
+        metrics = _metrics
+    with metrics.phase('parse'):
+        source, hunks = load_document(content)
+    diff = diff_hunks(source, hunks, strict, tracer, metrics=metrics, name=name, context=context, mode=mode)
+    return source, hunks, diff